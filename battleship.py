@@ -27,6 +27,19 @@ SHIPS = [
 
 # TODO: make this configurable from settings file
 INACTIVITY_TIMEOUT = 60  # seconds before we skip a player's turn
+DEBUG_LOG = False  # per-turn/per-input [DEBUG] prints from the multiplayer game. Separate from server.DEBUG_LOG, flip both for a full trace
+
+# Board text bits that only depend on the size, built once instead of on every board send
+ROW_LABELS = tuple(f"{chr(ord('A') + r):2}" for r in range(26))  # padded like f"{label:2}"
+_column_headers = {}  # {size: "   1 2 3 ..." line}
+
+
+def board_header(size):
+    """Column number line that goes above a board of the given size."""
+    header = _column_headers.get(size)
+    if header is None:
+        header = _column_headers[size] = "  " + "".join(str(i + 1).rjust(2) for i in range(size))
+    return header
 
 
 class PlayerDisconnectedException(Exception):
@@ -49,6 +62,8 @@ class Board:
         self.hidden_grid = [['.' for _ in range(size)] for _ in range(size)]
         self.display_grid = [['.' for _ in range(size)] for _ in range(size)]
         self.placed_ships = []
+        self.version = 0  # bumped on every grid change, lets callers cache what they rendered from it
+        self._renders = {}  # {show_hidden: (version, rows, text)}, see render()
 
     def place_ships_randomly(self, ships=SHIPS):
         for ship_name, ship_size in ships:
@@ -124,6 +139,7 @@ class Board:
         return True
 
     def do_place_ship(self, row, col, ship_size, orientation):
+        self.version += 1
         occupied = set()
         if orientation == 0:  # Horizontal
             for c_offset in range(ship_size):
@@ -142,11 +158,13 @@ class Board:
         if cell == 'S':  # Hit a ship!
             self.hidden_grid[row][col] = 'X'
             self.display_grid[row][col] = 'X'
+            self.version += 1
             sunk_ship_name = self._mark_hit_and_check_sunk(row, col)
             return ('hit', sunk_ship_name)
         elif cell == '.':  # Miss
             self.hidden_grid[row][col] = 'o'
             self.display_grid[row][col] = 'o'
+            self.version += 1
             return ('miss', None)
         elif cell in ('X', 'o'):  # Already shot here
             return ('already_shot', None)
@@ -174,6 +192,24 @@ class Board:
                 return False
         return True
 
+    def render_rows(self, show_hidden=False):
+        """One labelled text row per board row ("A  . . X o ..."), cached until the grid changes."""
+        return self._render(show_hidden)[1]
+
+    def render(self, show_hidden=False):
+        """The board as text: column header line, then the labelled rows. Cached until the grid changes,
+        so sending the same board again (retries, reconnects, final boards) doesn't re-join every row."""
+        return self._render(show_hidden)[2]
+
+    def _render(self, show_hidden):
+        cached = self._renders.get(show_hidden)
+        if cached is None or cached[0] != self.version:
+            grid = self.hidden_grid if show_hidden else self.display_grid
+            # rows are already lists of cells, so join them directly
+            rows = tuple(f"{ROW_LABELS[r_idx]} {' '.join(grid[r_idx])}" for r_idx in range(self.size))
+            cached = self._renders[show_hidden] = (self.version, rows, "\n".join((board_header(self.size),) + rows))
+        return cached
+
     def print_display_grid(self, show_hidden_board=False):  # For local testtig
         grid_to_print = self.hidden_grid if show_hidden_board else self.display_grid
 
@@ -187,8 +223,16 @@ class Board:
             print(f"{row_label:2} {row_str}")
 
 
+# Every valid "A1".."J10" spelled the usual way, so a normal shot/placement is one dict lookup.
+# Anything else (A01, bad input) still goes through the checks below for the error message
+_COORDINATES = {f"{chr(ord('A') + r)}{c + 1}": (r, c) for r in range(BOARD_SIZE) for c in range(BOARD_SIZE)}
+
+
 def parse_coordinate(coord_str):
     coord_str = coord_str.strip().upper()
+    coord = _COORDINATES.get(coord_str)
+    if coord is not None:
+        return coord
 
     # Basic val
     if len(coord_str) < 2 or len(coord_str) > 3:
@@ -217,6 +261,17 @@ def parse_coordinate(coord_str):
     return (row, col)
 
 
+def split_placement(token):
+    """'A1H' or 'A1 H' -> ('A1', 'H'), just 'A1' -> ('A1', None). Coordinates never end in H/V so it's not ambiguous"""
+    token = token.strip()
+    coord_str, _, orient_str = token.partition(" ")
+    if orient_str.strip():
+        return coord_str, orient_str.strip()
+    if len(token) > 2 and token[-1] in "HVhv":
+        return token[:-1], token[-1]
+    return token, None
+
+
 # Network game handling stuff below
 def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_queue, send_message_func, broadcast_board_func):
     """
@@ -225,8 +280,8 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
     Args:
         player1_data (dict): Player 1 info
         player2_data (dict): Player 2 info
-        p1_input_queue (queue.Queue): Queue for Player 1 input
-        p2_input_queue (queue.Queue): Queue for Player 2 input
+        p1_input_queue (server.PlayerInputQueue): Queue for Player 1 input
+        p2_input_queue (server.PlayerInputQueue): Queue for Player 2 input
         send_message_func (callable): Function to send messages to players
         broadcast_board_func (callable): Function to update spectators
     """
@@ -240,20 +295,16 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
     def send_msg_to_player(player_id, message):
         send_message_func(player_id, message)
 
+    def send_msg_to_players(player_ids, message):
+        # Same text to several players: built once here, and the server packs it once too
+        # (its packed-message cache hands the second player the first one's bytes)
+        for player_id in player_ids:
+            send_message_func(player_id, message)
+
     def send_board_to_player(player_id, board_to_send, show_hidden=False):
          try:
-            grid_to_print = board_to_send.hidden_grid if show_hidden else board_to_send.display_grid
-            message_lines = ["GRID"]
-            header = "  " + "".join(str(i + 1).rjust(2) for i in range(board_to_send.size))
-            message_lines.append(header)
-
-            for r_idx in range(board_to_send.size):
-                row_label = chr(ord('A') + r_idx)
-                row_content = " ".join(grid_to_print[r_idx][c_idx] for c_idx in range(board_to_send.size))
-                message_lines.append(f"{row_label:2} {row_content}")
-
-            message_lines.append("") # Empty line = end of grid
-            send_message_func(player_id, "\n".join(message_lines))
+            # Board.render caches the text until the board changes. Empty line = end of grid
+            send_message_func(player_id, f"GRID\n{board_to_send.render(show_hidden)}\n")
 
          except Exception as e:
              print(f"[ERROR] Failed to send board to {player_id}: {e}")
@@ -265,35 +316,59 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
         board = player_boards[player_id]
         player_tag = player_tags[player_id]
         player_queue = player_queues[player_id]
-        print(f"[DEBUG] Starting ship placement for {player_tag} ({player_id}).")
+        if DEBUG_LOG: print(f"[DEBUG] Starting ship placement for {player_tag} ({player_id}).")
 
         send_msg_to_player(player_id, f"[SYSTEM] Welcome, {player_tag}! Time to place your ships.")
 
+        # Rest of a batched line like "A1H, B1H, C1V", one entry per ship still to place
+        pending = []
+
+        def drop_batch(reason):
+            # Whatever's left of the batch won't be tried, say so instead of quietly re-prompting
+            if pending:
+                send_msg_to_player(player_id, f"[SYSTEM] {reason}, ignored the rest of the batch: {', '.join(t.strip() for t in pending)}")
+            return []
+
         for ship_name, ship_size in SHIPS:
             while True:  # Loop until this ship is placed
-                send_msg_to_player(player_id, f"\n[SYSTEM] {player_tag}, here's your board:")
-                send_board_to_player(player_id, board, show_hidden=True)
-                send_msg_to_player(player_id, f"[SYSTEM] Place your {ship_name} (size {ship_size}).")
-                send_msg_to_player(player_id, "[SYSTEM] Enter start coordinate (like A1):")
+                prompted = not pending # Batch entries skip the per-ship prompts
+                if prompted:
+                    send_msg_to_player(player_id, f"\n[SYSTEM] {player_tag}, here's your board:")
+                    send_board_to_player(player_id, board, show_hidden=True)
+                    send_msg_to_player(player_id, f"[SYSTEM] Place your {ship_name} (size {ship_size}).")
+                    send_msg_to_player(player_id, "[SYSTEM] Enter start coordinate (like A1), or several ships at once (like A1H, B1V):")
 
                 try:
-                    # Get starting position
-                    print(f"[DEBUG] {player_tag} ({player_id}) waiting for coordinate input...")
-                    coord_str = player_queue.get(timeout=INACTIVITY_TIMEOUT * 2)
-                    print(f"[DEBUG] {player_tag} ({player_id}) entered: '{coord_str}'")
-
-                    # Player wants to quit?
-                    if coord_str.lower() == 'quit':
-                        raise PlayerDisconnectedException(f"{player_id} quit during ship placement.")
-
-                    # Get orientation
-                    send_msg_to_player(player_id, "[SYSTEM] Enter orientation ('H' or 'V'):")
-                    print(f"[DEBUG] {player_tag} ({player_id}) waiting for orientation...")
-                    orient_str = player_queue.get(timeout=INACTIVITY_TIMEOUT * 2).upper()
-                    print(f"[DEBUG] {player_tag} ({player_id}) entered orient: '{orient_str}'")
-
-                    if orient_str.lower() == 'quit':
-                         raise PlayerDisconnectedException(f"{player_id} quit during ship placement.")
+                    # Get starting position (and maybe orientation + the next ships too)
+                    if pending:
+                        token = pending.pop(0)
+                    else:
+                        if DEBUG_LOG: print(f"[DEBUG] {player_tag} ({player_id}) waiting for coordinate input...")
+                        line = player_queue.get(timeout=INACTIVITY_TIMEOUT * 2)
+                        if DEBUG_LOG: print(f"[DEBUG] {player_tag} ({player_id}) entered: '{line}'")
+
+                        # Player wants to quit?
+                        if line.lower() == 'quit':
+                            raise PlayerDisconnectedException(f"{player_id} quit during ship placement.")
+
+                        pending = [t for t in line.split(",") if t.strip()]
+                        token = pending.pop(0) if pending else line
+                    coord_str, orient_str = split_placement(token)
+
+                    if orient_str is None:
+                        # Get orientation
+                        # Only a lone coordinate gets asked, batches need it spelled out
+                        pending = drop_batch(f"No orientation given for {coord_str.strip().upper()}")
+                        if not prompted: # Came out of a batch, say which ship this one is for
+                            send_msg_to_player(player_id, f"[SYSTEM] Place your {ship_name} (size {ship_size}) at {coord_str.strip().upper()}.")
+                        send_msg_to_player(player_id, "[SYSTEM] Enter orientation ('H' or 'V'):")
+                        if DEBUG_LOG: print(f"[DEBUG] {player_tag} ({player_id}) waiting for orientation...")
+                        orient_str = player_queue.get(timeout=INACTIVITY_TIMEOUT * 2)
+                        if DEBUG_LOG: print(f"[DEBUG] {player_tag} ({player_id}) entered orient: '{orient_str}'")
+
+                        if orient_str.lower() == 'quit':
+                             raise PlayerDisconnectedException(f"{player_id} quit during ship placement.")
+                    orient_str = orient_str.upper()
 
                     # Process the inputs
                     row, col = parse_coordinate(coord_str)
@@ -308,6 +383,8 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
                     # Error checks
                     if orientation_val == -1:
                         send_msg_to_player(player_id, "[!] I need 'H' for horizontal or 'V' for vertical. Try again.")
+                        # Rest of a batch was planned around this one, start over from here
+                        pending = drop_batch(f"Stopped at {token.strip()}")
                         continue
 
                     # Try to place the ship
@@ -318,15 +395,17 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
                         break  # Ship placed, go to next ship
                     else:
                         send_msg_to_player(player_id, f"[!] Can't place {ship_name} at {coord_str}{orient_str}. It doesn't fit or overlaps. Try again.")
+                        pending = drop_batch(f"Stopped at {token.strip()}")
 
                 except queue.Empty:
                     # Player took too long
-                    print(f"[DEBUG] {player_tag} ({player_id}) placement timeout.")
+                    if DEBUG_LOG: print(f"[DEBUG] {player_tag} ({player_id}) placement timeout.")
                     raise PlayerTimeoutException(f"{player_id} took too long during ship placement (>{INACTIVITY_TIMEOUT * 2}s)")
 
                 except ValueError as e:  # Coordinate parsing error
-                    print(f"[DEBUG] {player_tag} ({player_id}) bad input: {e}")
+                    if DEBUG_LOG: print(f"[DEBUG] {player_tag} ({player_id}) bad input: {e}")
                     send_msg_to_player(player_id, f"[!] Invalid input: {e}. Try again.")
+                    pending = drop_batch(f"Stopped at {token.strip()}")
 
                 except PlayerDisconnectedException:
                     raise  # Pass this up the chain
@@ -334,12 +413,14 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
                 except Exception as e:
                      print(f"[ERROR] Weird error during placement for {player_id}: {type(e).__name__}: {e}")
                      send_msg_to_player(player_id, f"[SYSTEM] Something went wrong. Let's try again.")
+                     pending = drop_batch("Stopped there")
 
         # All ships placed
+        pending = drop_batch("All ships are placed")
         send_msg_to_player(player_id, f"\n[SYSTEM] {player_tag}, all ships placed!")
         send_board_to_player(player_id, board, show_hidden=True)
         send_msg_to_player(player_id, "[SYSTEM] Waiting for the other player...")
-        print(f"[DEBUG] Ship placement done for {player_tag} ({player_id}).")
+        if DEBUG_LOG: print(f"[DEBUG] Ship placement done for {player_tag} ({player_id}).")
 
 
     # main logic
@@ -352,7 +433,7 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
         #Set up ship placement threads
         placement_threads = []
         placement_status = {}  # Will hold results of placement
-        print("[DEBUG] Starting placement threads.")
+        if DEBUG_LOG: print("[DEBUG] Starting placement threads.")
 
         def placement_worker(player_id_worker):
             # Thread function for ship placement
@@ -370,13 +451,13 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
             placement_threads.append(thread)
             thread.start()
 
-        print("[DEBUG] Waiting for placement to finish.")
+        if DEBUG_LOG: print("[DEBUG] Waiting for placement to finish.")
         for thread in placement_threads:
             thread.join()  # Wait for placements to complete
-        print("[DEBUG] Placement threads finished.")
+        if DEBUG_LOG: print("[DEBUG] Placement threads finished.")
 
         # Check how placement went
-        print("[DEBUG] Checking placement results.")
+        if DEBUG_LOG: print("[DEBUG] Checking placement results.")
         for player_data in [player1_data, player2_data]:
              p_id = player_data['id']
              status = placement_status.get(p_id)
@@ -395,17 +476,16 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
                  print(f"[ERROR] Unexpected placement status for {p_id}: {status}")
                  raise Exception(f"Weird placement status for {p_id}: {status}")
 
-        print("[DEBUG] Ships placed successfully. Starting battle phase!")
+        if DEBUG_LOG: print("[DEBUG] Ships placed successfully. Starting battle phase!")
 
         # Ready to play
-        send_msg_to_player(player1_data['id'], "[SYSTEM] Both players ready. Let the battle begin!")
-        send_msg_to_player(player2_data['id'], "[SYSTEM] Both players ready. Let the battle begin!")
+        send_msg_to_players((player1_data['id'], player2_data['id']), "[SYSTEM] Both players ready. Let the battle begin!")
         broadcast_board_func(player_boards[player1_data['id']], player_boards[player2_data['id']])  # Update spectators
 
 
         # gameplay loop
         turn_count = 0
-        print("[DEBUG] Starting main game turns.")
+        if DEBUG_LOG: print("[DEBUG] Starting main game turns.")
 
         while game_active:
             current_player_id = player1_data['id'] if turn_count % 2 == 0 else player2_data['id']
@@ -416,7 +496,7 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
             target_board = player_boards[opponent_player_id]
             current_player_queue = player_queues[current_player_id]
 
-            print(f"[DEBUG] Turn {turn_count+1}: {current_player_tag}'s turn")
+            if DEBUG_LOG: print(f"[DEBUG] Turn {turn_count+1}: {current_player_tag}'s turn")
 
             # Tell players what's happening
             send_msg_to_player(current_player_id, f"\n--- {current_player_tag}, your turn! ---")
@@ -432,16 +512,16 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
             # Get their move
             guess_input = None
             try:
-                print(f"[DEBUG] {current_player_tag} ({current_player_id}) waiting for move input...")
+                if DEBUG_LOG: print(f"[DEBUG] {current_player_tag} ({current_player_id}) waiting for move input...")
                 guess_input = current_player_queue.get(timeout=INACTIVITY_TIMEOUT)
-                print(f"[DEBUG] {current_player_tag} ({current_player_id}) entered: '{guess_input}'")
+                if DEBUG_LOG: print(f"[DEBUG] {current_player_tag} ({current_player_id}) entered: '{guess_input}'")
 
                 # Reset timeout counter since they responded
                 timeout_count[current_player_id] = 0
 
             except queue.Empty:
                  # took too long
-                 print(f"[DEBUG] {current_player_tag} ({current_player_id}) timed out.")
+                 if DEBUG_LOG: print(f"[DEBUG] {current_player_tag} ({current_player_id}) timed out.")
                  timeout_count[current_player_id] += 1
 
                  timeout_msg = f"{current_player_tag} took too long (>{INACTIVITY_TIMEOUT}s). "
@@ -478,7 +558,7 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
 
             # Process their move if we have one
             if guess_input is not None:
-                print(f"[DEBUG] Processing move: '{guess_input}'")
+                if DEBUG_LOG: print(f"[DEBUG] Processing move: '{guess_input}'")
                 try:
                     # Convert coordinate string to board positiong
                     row, col = parse_coordinate(guess_input)
@@ -527,13 +607,13 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
                         final_msg = f"[SYSTEM] GAME OVER! {current_player_tag} WINS! All {opponent_player_tag}'s ships are sunk."
                         print(f"[GAME INFO] Game over. {current_player_tag} wins.")
 
+                        send_msg_to_players((current_player_id, opponent_player_id), final_msg)
+
                         # Send final info to winner
-                        send_msg_to_player(current_player_id, final_msg)
                         send_msg_to_player(current_player_id, f"\n[SYSTEM] Final enemy board:")
                         send_board_to_player(current_player_id, target_board, show_hidden=False)
 
                         # Send final info to loser
-                        send_msg_to_player(opponent_player_id, final_msg)
                         send_msg_to_player(opponent_player_id, f"\n[SYSTEM] Your final board:")
                         send_board_to_player(opponent_player_id, target_board, show_hidden=True)
                         break  # Exit game loop
@@ -542,7 +622,7 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
                          turn_count += 1
 
                 except ValueError as e:  # Bad coord
-                    print(f"[DEBUG] Bad coordinate: '{guess_input}' - {e}")
+                    if DEBUG_LOG: print(f"[DEBUG] Bad coordinate: '{guess_input}' - {e}")
                     send_msg_to_player(current_player_id, f"[!] Invalid move '{guess_input}': {e}. Try again.")
                     # try again
                     continue
@@ -558,11 +638,11 @@ def run_multiplayer_game(player1_data, player2_data, p1_input_queue, p2_input_qu
         # Update server with final board state
         try:
             import server
-            with server.lock:
+            with server.game_lock:
                 server.active_games[player1_data['id']]["board"] = player_boards[player1_data['id']]
                 server.active_games[player2_data['id']]["board"] = player_boards[player2_data['id']]
         except Exception as e:
-            print(f"[DEBUG] Couldn't save final boards: {e}")
+            if DEBUG_LOG: print(f"[DEBUG] Couldn't save final boards: {e}")
 
 
 # Single player test mode
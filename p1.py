@@ -1,5 +1,6 @@
 import socket
 import time
+from packet import pack_packet, PacketReader, USER_INPUT
 
 HOST = '127.0.0.1'
 PORT = 5001
@@ -18,20 +19,31 @@ inputsToSend = [
     "h"     # 5th ship orientation
 ]
 
+def read_lines(sock):
+    # Server text line by line, straight off recv() + the packet framing (no makefile/TextIOWrapper)
+    reader = PacketReader()
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            return
+        for packet in reader.read_packets(data):
+            if packet is None:
+                continue # corrupted, skip it
+            for line in packet[2].decode().split("\n"):
+                yield line
+
 def main():
     with socket.create_connection((HOST, PORT)) as sock:
-        rfile = sock.makefile('r')
-        wfile = sock.makefile('w')
+        lines = read_lines(sock)
 
         # This should probably be read from user input but hardcoding for now
-        wfile.write("P1\n")
-        wfile.flush()
+        sock.sendall(pack_packet(0, USER_INPUT, b"P1"))
         print("[CLIENT] Sent username: P1")
 
         ix = 0
         while ix < len(inputsToSend):
-            server_line = rfile.readline()
-            if not server_line:
+            server_line = next(lines, None)
+            if server_line is None:
                 break
             print(f"[SERVER] {server_line.strip()}")
             # lazy prompt checkign
@@ -40,15 +52,14 @@ def main():
                 out = inputsToSend[ix]
                 print(f"[CLIENT] Sending: {out}")
                 # DEBUG: sent input"
-                wfile.write(out + "\n")
-                wfile.flush()
+                sock.sendall(pack_packet(ix + 1, USER_INPUT, out.encode()))
                 ix += 1
-                time.sleep(0.2)  # Small delay to avoid flooding
+                time.sleep(0.6)  # Small delay to stay under the server's input rate limit (2/s)
 
         # print anything else server says (should limit this?)
         for _ in range(10):
-            server_line = rfile.readline()
-            if not server_line:
+            server_line = next(lines, None)
+            if server_line is None:
                 break
             print(f"[SERVER] {server_line.strip()}")
 
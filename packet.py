@@ -28,12 +28,15 @@ GAME_STATE      = 5  # Game start, end, or status updates
 ERROR           = 6  # Error or invalid packet notification
 ACK             = 7  # Acknowledgement (if we get there)
 
+_CHECKSUM_BYTES = tuple(bytes((i,)) for i in range(256))
+_HEADER = struct.Struct('!HBH') # compiled once, seq / type / payload length
+
 def pack_packet(seq_num, pktType, payload_bytes):
     payload_len = len(payload_bytes)
-    header      = struct.pack('!HBH', seq_num, pktType, payload_len)
-    body        = header + payload_bytes
-    checksum    = sum(body) % 256
-    packet      = body + struct.pack('!B', checksum)
+    header      = _HEADER.pack(seq_num, pktType, payload_len)
+    # same byte sum as over header + payload, just without building that intermediate copy
+    checksum    = (sum(header) + sum(payload_bytes)) % 256
+    packet      = b"".join((header, payload_bytes, _CHECKSUM_BYTES[checksum]))
     return packet
 
 # might want to split this into smaller functions later
@@ -61,6 +64,27 @@ def recv_full(conn, n):
         data += chunk
     return data
 
+def send_many(conn, parts):
+    """Helper to send several byte strings in as few syscalls as possible.
+    Uses one vectored sendmsg where the platform has it, and handles short writes."""
+    if not hasattr(conn, "sendmsg"):  # e.g. Windows, just glue them together
+        data = b"".join(parts)
+        conn.sendall(data)
+        return len(data)
+    total = 0
+    pending = [p for p in parts if p]
+    first = 0 # pending[first:] is what's left, so short writes don't pop(0) through the list
+    while first < len(pending):
+        sent = conn.sendmsg(pending[first:] if first else pending)
+        total += sent
+        # Skip whatever got fully sent, trim the one that was cut off
+        while first < len(pending) and sent >= len(pending[first]):
+            sent -= len(pending[first])
+            first += 1
+        if sent:
+            pending[first] = memoryview(pending[first])[sent:]
+    return total
+
 def receive_packet(conn):
     # 1. Grab the first 5 bytes (header stuff)
     header = recv_full(conn, 5)
@@ -80,6 +104,37 @@ def receive_packet(conn):
         return None
 
 
+class PacketReader:
+    """Non-blocking counterpart to receive_packet: feed it whatever recv() returned
+    and it hands back the packets that are complete, keeping any partial one for next time."""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def read_packets(self, data):
+        """Returns a list of (seq, pkt_type, payload) for every packet completed by data.
+        A corrupted packet shows up as None, same as receive_packet returns."""
+        buf = self.buf
+        buf += data
+        packets = []
+        start = 0
+        # Same checks as unpack_packet, but straight off buf: only the payload gets copied out
+        with memoryview(buf) as view: # released before buf gets trimmed below
+            while len(buf) - start >= 5:
+                seq, pkt_type, payload_len = _HEADER.unpack_from(buf, start)
+                end = start + 5 + payload_len + 1 # header + payload + checksum
+                if len(buf) < end:
+                    break # rest hasn't arrived yet
+                if sum(view[start:end - 1]) % 256 != buf[end - 1]:
+                    print("Corrupted packet received:", "Checksum mismatch")
+                    packets.append(None)
+                else:
+                    packets.append((seq, pkt_type, bytes(view[start + 5:end - 1])))
+                start = end
+        del buf[:start]
+        return packets
+
+
 # TESTS!!!!!!!1!!!!!
 if __name__ == "__main__":
     #matching type
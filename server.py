@@ -1,12 +1,21 @@
 # server.py
 
 import socket
+import selectors
+import sys
+import errno
+import struct
+import collections
 import threading
 import time
 import gc
 import queue
+import contextlib
+import itertools
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 from battleship import Board, parse_coordinate, SHIPS, BOARD_SIZE, run_multiplayer_game, PlayerDisconnectedException, PlayerTimeoutException
-from packet import pack_packet, SYSTEM_MESSAGE, receive_packet, USER_INPUT
+from packet import pack_packet, send_many, PacketReader, SYSTEM_MESSAGE, USER_INPUT
 
 HOST = '127.0.0.1'
 PORT = 5001
@@ -14,308 +23,787 @@ PORT = 5001
 # Global server state
 
 clients = {} # {client_id:
-                #{"r": rfile, "w": wfile,
-                # "addr": addr,
+                #{"addr": addr,
                 # "id": client_id,
                 # "role": "player" or "spectator",
-                # "input_queue": queue.Queue() if player,
-                # "last_input_time": float,
-                # "socket": socket_obj}}
+                # "input_queue": PlayerInputQueue() if player,
+                # "last_input_ns": int (time.monotonic_ns()),
+                # "socket": socket_obj,
+                # "outbox": queue.Queue() drained by "writer" thread}}
 
 disconnected_players = {}
 active_games = {}  # {username:
                 #        {"board": ...,
-                #         "rfile": ...,
-                #         "wfile": ...,
                 #         "disconnected": False,
-                #         "reconnect_deadline": None, ...}}
+                #         "reconnect_deadline": None,
+                #         "opponent": other username}}
 
 players_waiting = []
 spectators_waiting = []
+spectator_rank = {}  # {client_id: index in spectators_waiting}, kept in sync by _enqueue/_dequeue_spectator
 game_in_progress = False
 game_thread = None
-lock = threading.RLock() # Lock for accessing server state
+
+# Server state is split across three locks so unrelated work doesn't all queue up on one:
+#   clients_lock - clients dict, each client's fields (role, input_queue, socket...), _broadcast_targets
+#   queue_lock   - players_waiting, spectators_waiting, spectator_rank
+#   game_lock    - game_in_progress, game_thread, active_games, disconnected_players
+# When you need more than one, ALWAYS take them in that order (clients -> queue -> game), or use
+# all_locks(). None of them are reentrant: never call something that takes a lock you already hold.
+# Reading game_in_progress without game_lock is fine for a hint, it's a single bool.
+clients_lock = threading.Lock()
+queue_lock = threading.Lock()
+game_lock = threading.Lock()
+
+# (client_id, client_data) pairs that broadcast_to_all queues to.
+# Copy-on-write: mutators build a new list under clients_lock, readers just grab the reference
+_broadcast_targets = []
+
+
+@contextlib.contextmanager
+def all_locks():
+    """Takes every state lock, in order. For the few places that touch clients, queues and game state at once."""
+    with clients_lock, queue_lock, game_lock:
+        yield
+
+# (read state, packet) from the reactor in main() for the input workers. packet None = connection ended.
+# A connection always goes to the same worker (picked by fd, see _accept_client), so its packets
+# are still handled in order, and a reused fd's close is handled before the new connection's packets
+_input_qs = []
+
+# Set whenever the waiting queues change, spectator_position_worker sends the updates
+positions_dirty = threading.Event()
+# Set whenever a game might be startable (someone joined/left, a game ended), matchmaker_worker checks
+matchmaking_dirty = threading.Event()
+
+# Reconnect countdown ticks for disconnected players, a heap of (due, seq, client_id, seconds_left, entry).
+# One reconnect_timer_worker thread walks it instead of a sleeping thread per disconnect.
+# entry is the disconnected_players dict the countdown belongs to, if that's gone/replaced the tick is dropped
+_reconnect_ticks = []
+_reconnect_cv = threading.Condition()
+_reconnect_seq = itertools.count() # tie-breaker, so the heap never compares the dicts
+
+
+class PlayerInputQueue:
+    """Player input channel: the input worker puts, the game thread gets.
+    Same put_nowait/get(timeout) interface (and queue.Full/queue.Empty) as queue.Queue, but backed by
+    a C SimpleQueue (one lock, no not_full/not_empty conditions). SimpleQueue has no maxsize, so the
+    bound is checked here; with a single producer that check can't race."""
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._items = queue.SimpleQueue()
+
+    def put_nowait(self, item):
+        if self.maxsize and self._items.qsize() >= self.maxsize:
+            raise queue.Full
+        self._items.put_nowait(item)
+
+    def get(self, timeout=None):
+        return self._items.get(timeout=timeout)
+
+    def qsize(self):
+        return self._items.qsize()
 
 GAME_START_COUNTDOWN = 5  # seconds
 RECONNECT_TIMEOUT = 30
+POSITION_UPDATE_DELAY = 0.05  # seconds to coalesce queue changes into one position update
 
 #Rate Limiting and Connection Limits
 MAX_CONNECTIONS = 6
+# One slot per open connection, taken at accept and given back when the connection ends
+# (see _release_conn_slot), so fds stay bounded even before anyone has sent a username
+_conn_slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+_slot_socks = {}  # {socket: True} for every socket still holding one of _conn_slots
+SHUTDOWN_CLOSE_WORKERS = 32  # cap on threads used to close client sockets at shutdown
+# accept() errors that only affect the one pending connection vs ones that mean we're out of fds
+ACCEPT_RETRY_ERRNOS = (errno.ECONNABORTED, errno.EPROTO)
+ACCEPT_BACKOFF_ERRNOS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+ACCEPT_BACKOFF = 0.5  # seconds the listener stays out of the selector after one of those
+OUTBOX_SIZE = 256  # queued writes per client before we treat it as too slow and drop it
+SEND_BATCH_WINDOW = 0.002  # seconds a writer waits for more packets before sending
+SEND_BATCH_MAX = 64 * 1024  # bytes, send right away once a batch gets this big
+CLOSE_FLUSH_TIMEOUT = 1.0  # seconds to let a client's writer flush before closing its socket
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)  # not on Windows, _send_nowait falls back to setblocking(False)
+_LINGER_ABORT = struct.pack("ii", 1, 0)  # SO_LINGER on with 0 timeout: close() resets instead of draining
+INPUT_WORKERS = 4  # threads handling client packets, commands run one at a time per client either way
+# select() timeout for the reactor. POSIX signals interrupt select() so Ctrl+C gets through while it
+# blocks forever, Windows' select() doesn't so there we still wake up once a second to let it in
+SELECT_TIMEOUT = 1.0 if sys.platform == "win32" else None
+MESSAGE_PACKET_CACHE_SIZE = 512  # packed system messages kept for reuse before the cache is reset
+RECV_SIZE = 16384  # bytes per recv() when the reactor says a client is readable
+SOCKET_BUFFER_SIZE = 256 * 1024  # SO_SNDBUF/SO_RCVBUF, set on the listener so every accepted socket inherits it
+THREAD_STACK_SIZE = 512 * 1024  # per-thread stack, default is 8MB on Linux and our threads barely recurse
 INPUT_RATE_LIMIT_PER_SECOND = 2
-INPUT_RATE_DELAY = 1.0 / INPUT_RATE_LIMIT_PER_SECOND
+PLAYER_INPUT_QUEUE_SIZE = 256  # moves a player can have queued before getting "Input queue is full"
+INPUT_RATE_DELAY_NS = 1_000_000_000 // INPUT_RATE_LIMIT_PER_SECOND  # int ns, compared against monotonic_ns()
+
+_message_packets = {}  # {message str: packed SYSTEM_MESSAGE bytes}, see _pack_message
+
+# Static welcome bits, encoded/packed once instead of on every accept
+_USERNAME_PROMPT_PACKET = pack_packet(0, SYSTEM_MESSAGE, b"Enter your username:")
+_HELP_PACKET = pack_packet(0, SYSTEM_MESSAGE, b"[SYSTEM] Type /help for available commands.")
+_USERNAME_TAKEN_PACKET = pack_packet(0, SYSTEM_MESSAGE, b"Username already in use. Please reconnect with a different name.")
+# Plain text, not a packet (always was)
+_MAX_CONNECTIONS_REFUSAL_BYTES = f"[SYSTEM] Connection refused: Maximum connections ({MAX_CONNECTIONS}) reached. Please try again later.\n".encode()
+_WAITING_FOR_OPPONENT_BYTES = b"[SYSTEM] Waiting for another player to join...\n"
+_GAME_IN_PROGRESS_BYTES = b"[SYSTEM] A game is currently in progress. You will receive updates.\n"
+_WAITING_FOR_GAME_BYTES = b"[SYSTEM] Waiting for players to start a new game.\n"
+# Countdown ticks, {seconds_left: packet}
+_COUNTDOWN_PACKETS = {i: pack_packet(0, SYSTEM_MESSAGE, f"[SYSTEM] New game starting in {i} seconds...".encode())
+                      for i in range(1, GAME_START_COUNTDOWN + 1)}
+_GAME_STARTING_NOW_PACKET = pack_packet(0, SYSTEM_MESSAGE, b"[SYSTEM] Game is starting now!")
+# Fixed command/input replies. The rate limit one goes out on every over-eager keypress
+_RATE_LIMIT_PACKET = pack_packet(0, SYSTEM_MESSAGE, b"[SYSTEM] Input rate limit exceeded. Slow down.")
+_INPUT_QUEUE_FULL_PACKET = pack_packet(0, SYSTEM_MESSAGE, b"[SYSTEM] Input queue is full. Please wait a moment.")
+_INPUT_ERROR_PACKET = pack_packet(0, SYSTEM_MESSAGE, b"[SYSTEM] An error occurred processing your input.")
+_CHAT_USAGE_PACKET = pack_packet(0, SYSTEM_MESSAGE, b"[SYSTEM] Usage: /chat <your message>")
+_QUIT_PACKET = pack_packet(0, SYSTEM_MESSAGE, b"[SYSTEM] You have chosen to quit. Disconnecting.")
+_SHUTDOWN_PACKET = pack_packet(0, SYSTEM_MESSAGE, b"[SYSTEM] Server is shutting down.")
+# /help reply per role, None is the transitional state
+_HELP_TEXT_PACKETS = {
+    "player": pack_packet(0, SYSTEM_MESSAGE, b"[SYSTEM] Available commands: /help, /quit, /chat <message>"),
+    "spectator": pack_packet(0, SYSTEM_MESSAGE, b"[SYSTEM] Available commands: /help, /quit, /status, /chat <message>"),
+    None: pack_packet(0, SYSTEM_MESSAGE, b"[SYSTEM] Available commands: /help, /quit (You are in a transitional state)"),
+}
+# Queue position lines, indexed by position. Nobody can be further back than MAX_CONNECTIONS
+_PLAYER_QUEUE_LINES = tuple(f"[SYSTEM] You are #{i} in the player queue.\n".encode() for i in range(MAX_CONNECTIONS + 1))
+_SPECTATOR_QUEUE_LINES = tuple(f"[SYSTEM] You are Spectator #{i} in the queue.\n".encode() for i in range(MAX_CONNECTIONS + 1))
+# Spectator board view, only depends on BOARD_SIZE
+_GRID_SEPARATOR_LEN = (BOARD_SIZE * 2) + 2 + len("    |    ") + (BOARD_SIZE * 2) + 2 # so that they are evenly spaced
+_GRID_HEADER_LINES = (
+    "GRID",
+    "PLAYER 1                  PLAYER 2",
+    "-" * (_GRID_SEPARATOR_LEN if _GRID_SEPARATOR_LEN > 0 else 40), #min length
+)
+_last_board_broadcast = None # (board1, version1, board2, version2, packet), see broadcast_game_board_state
+
+DEBUG_LOG = False  # per-event [DEBUG] trace. Off by default, the f-strings aren't even built then
+
+# Log lines get appended here and written to stderr by _log_writer in batches,
+# so client threads never queue up on the stdout lock. deque.append is atomic, no lock needed
+LOG_QUEUE_SIZE = 65536  # oldest lines get dropped if the writer falls this far behind
+LOG_BATCH_SIZE = 128
+log_q = collections.deque(maxlen=LOG_QUEUE_SIZE)
+_log_wakeup = threading.Event() # set by log() when there's something to write, the writer sleeps on it
+_log_stopping = False
+_log_writer_thread = None
+
+def log(msg):
+    """Queue a log line for the writer thread."""
+    log_q.append(msg)
+    if not _log_wakeup.is_set(): # plain attribute read, only pay for the set() when the writer is asleep
+        _log_wakeup.set()
+
+def flush_log():
+    """Write out everything currently queued. Only one thread should be draining at a time."""
+    while log_q:
+        batch = []
+        try:
+            while len(batch) < LOG_BATCH_SIZE:
+                batch.append(log_q.popleft())
+        except IndexError:
+            pass # Drained
+        batch.append("")
+        sys.stderr.write("\n".join(batch))
+        sys.stderr.flush()
+
+def _log_writer():
+    while True:
+        _log_wakeup.wait()
+        _log_wakeup.clear() # Before draining, so a line logged mid-flush wakes us again
+        flush_log()
+        if _log_stopping:
+            return
 
-print(f"[DEBUG] SERVER.PY: <module>: Initializing server with HOST: {HOST}, PORT: {PORT}")
+def start_log_writer():
+    global _log_writer_thread, _log_stopping
+    if _log_writer_thread is None or not _log_writer_thread.is_alive():
+        _log_stopping = False
+        _log_writer_thread = threading.Thread(target=_log_writer, daemon=True)
+        _log_writer_thread.start()
+
+def stop_log_writer(timeout=1.0):
+    """Lets the writer drain what's queued and exit, then writes anything it didn't get to.
+    The final flush_log only runs once the writer is gone, so the tail can't come out interleaved."""
+    global _log_stopping
+    writer = _log_writer_thread
+    if writer is not None and writer.is_alive():
+        _log_stopping = True
+        _log_wakeup.set()
+        writer.join(timeout)
+        if writer.is_alive():
+            return # Stuck on stderr, leave it be rather than drain alongside it
+    flush_log()
+
+if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: <module>: Initializing server with HOST: {HOST}, PORT: {PORT}")
 
 
 def send_message_to_client(client_id, message, pkt_type=SYSTEM_MESSAGE):
-    """Safely sends a message to a client."""
+    """Safely sends a message to a client (queued on its outbox, written by its writer thread)."""
     # print(f"[DEBUG] SERVER.PY: send_message_to_client: Attempting to send message to {client_id}: {message[:50]}...") # Log message attempt
-    with lock:
-        client_data = clients.get(client_id)
-        conn = client_data.get("socket") if client_data else None
-    if conn:
+    # No lock: a single dict read is atomic under the GIL
+    client_data = clients.get(client_id)
+    if client_data:
+        _enqueue_packet(client_id, client_data, _pack_message(message, pkt_type))
+    # else:
+        # print(f"[DEBUG] SERVER.PY: send_message_to_client: Attempted to send to non-existent or closed client {client_id}")
+
+
+def send_messages_to_client(client_id, messages, pkt_type=SYSTEM_MESSAGE):
+    """Sends several messages to a client as separate packets but in one vectored send."""
+    send_packets_to_client(client_id, [_pack_message(message, pkt_type) for message in messages])
+
+
+def _pack_message(message, pkt_type=SYSTEM_MESSAGE):
+    """pack_packet for a text message, reusing the bytes for system messages we've sent before.
+    The game sends the same prompts/results every turn ("Enter orientation", "MISS!", ...)."""
+    if pkt_type != SYSTEM_MESSAGE:
+        return pack_packet(0, pkt_type, message.encode())
+    packet = _message_packets.get(message)
+    if packet is None:
+        packet = pack_packet(0, pkt_type, message.encode())
+        # Boards and "fired at X" lines don't repeat much, so just start over once it fills up.
+        # The recurring prompts are back in after a turn or two
+        if len(_message_packets) >= MESSAGE_PACKET_CACHE_SIZE:
+            _message_packets.clear()
+        _message_packets[message] = packet
+    return packet
+
+
+def send_packet_to_client(client_id, packet):
+    """Sends an already packed packet to a client, e.g. one of the prebuilt _*_PACKET constants."""
+    client_data = clients.get(client_id)
+    if client_data:
+        _enqueue_packet(client_id, client_data, packet)
+
+
+def send_packets_to_client(client_id, packets):
+    """Sends already packed packets to a client, queued as one write."""
+    client_data = clients.get(client_id)
+    if client_data:
+        _enqueue_packet(client_id, client_data, b"".join(packets))
+
+
+def _enqueue_packet(client_id, client_data, packet):
+    """Puts packed bytes on a client's outbox. Never blocks: a client that's
+    OUTBOX_SIZE writes behind gets its socket shut down instead of stalling the sender."""
+    outbox = client_data.get("outbox")
+    if outbox is None:
+        return # Writer already stopped, client is on its way out
+    try:
+        outbox.put_nowait(packet)
+    except queue.Full:
+        log(f"[INFO] Client {client_id} is too slow ({OUTBOX_SIZE} writes queued). Disconnecting.")
+        client_data["dead"] = True
+        # Reactor sees the EOF, and the input worker's _client_input_closed does the usual remove_client (incl. reconnect window for players)
+        try: client_data["socket"].shutdown(socket.SHUT_RDWR)
+        except: pass
+
+
+def _send_nowait(conn, data):
+    """One-shot send on a socket that has no writer thread yet (prompt, refusals).
+    Never blocks the reactor/input worker: if the kernel buffer can't take it, it's dropped."""
+    try:
+        if _MSG_DONTWAIT:
+            conn.send(data, _MSG_DONTWAIT)
+        else:
+            # No per-call flag on this platform (Windows): flip the socket to non-blocking for this one send
+            conn.setblocking(False)
+            try:
+                conn.send(data)
+            finally:
+                conn.setblocking(True)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _start_client_writer(client_id, client_data, conn):
+    """Gives the client a fresh outbox and writer thread for conn. Call with clients_lock held."""
+    outbox = queue.Queue(maxsize=OUTBOX_SIZE)
+    writer = threading.Thread(target=client_writer, args=(client_id, conn, outbox), daemon=True)
+    client_data["outbox"] = outbox
+    client_data["writer"] = writer
+    client_data["dead"] = False # Reconnects reuse the dict
+    writer.start()
+
+
+def _stop_client_writer(client_data, flush_timeout=0):
+    """Stops the client's writer after whatever is already queued, waiting up to flush_timeout for it."""
+    outbox = client_data.get("outbox")
+    writer = client_data.get("writer")
+    client_data["outbox"] = None
+    if outbox is None:
+        return
+    try:
+        outbox.put_nowait(None)
+    except queue.Full:
+        return # Too far behind to bother flushing, the socket close will end it
+    if flush_timeout and writer and writer is not threading.current_thread():
+        writer.join(flush_timeout)
+
+
+def client_writer(client_id, conn, outbox):
+    """Thread function that writes one client's queued packets to its socket.
+    Only this thread ever blocks on a slow client. Besides packets, the outbox can hold None (stop)
+    and Event markers, which get set once everything queued before them is written."""
+    stopping = False
+    while not stopping:
+        packet = outbox.get()
+        if packet is None:
+            break
+        if isinstance(packet, threading.Event):
+            packet.set() # Nothing pending
+            continue
+        flushed = None
+        # Give bursts (board + turn prompt, countdown + broadcasts...) a moment to pile up
+        # and write them all in one syscall
+        batch = [packet]
+        batch_size = len(packet)
+        deadline = time.monotonic() + SEND_BATCH_WINDOW
+        while batch_size < SEND_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            try:
+                # Once the window's up, still take whatever is already waiting
+                packet = outbox.get(timeout=remaining) if remaining > 0 else outbox.get_nowait()
+            except queue.Empty:
+                break
+            if packet is None:
+                stopping = True # Flush this batch, then stop
+                break
+            if isinstance(packet, threading.Event):
+                flushed = packet # Set after this batch is out
+                break
+            batch.append(packet)
+            batch_size += len(packet)
         try:
-            packet = pack_packet(0, pkt_type, message.encode())
-            conn.sendall(packet)
+            send_many(conn, batch)
         except (socket.error, BrokenPipeError, ConnectionResetError) as e:
-            print(f"[INFO] Client {client_id} disconnected during send: {e}")
-            # Connection lost, handle removal
-            remove_client(client_id)
+            log(f"[INFO] Client {client_id} disconnected during send: {e}")
+            _writer_failed(client_id, conn)
+            break
         except Exception as e:
-             print(f"[ERROR] SERVER.PY: send_message_to_client: Unexpected error sending to {client_id}: {e}")
-             remove_client(client_id)
-        # else:
-            # print(f"[DEBUG] SERVER.PY: send_message_to_client: Attempted to send to non-existent or closed client {client_id}")
+            log(f"[ERROR] SERVER.PY: client_writer: Unexpected error sending to {client_id}: {e}")
+            _writer_failed(client_id, conn)
+            break
+        if flushed is not None:
+            flushed.set()
+
+
+def _wait_for_outboxes(client_ids, timeout):
+    """Blocks until everything already queued for these clients has been written, or timeout.
+    Dead/stopped clients are skipped, a writer that fails just never sets its marker."""
+    markers = []
+    for client_id in client_ids:
+        client_data = clients.get(client_id)
+        outbox = client_data.get("outbox") if client_data else None
+        if outbox is None or client_data.get("dead"):
+            continue
+        marker = threading.Event()
+        try:
+            outbox.put_nowait(marker)
+        except queue.Full:
+            continue
+        markers.append(marker)
+    deadline = time.monotonic() + timeout
+    for marker in markers:
+        marker.wait(max(0, deadline - time.monotonic()))
+
+
+def _writer_failed(client_id, conn):
+    # Only remove if this is still their socket, a reconnect may have swapped in a new one already
+    client_data = clients.get(client_id)
+    if client_data and client_data.get("socket") is conn:
+        client_data["dead"] = True
+        remove_client(client_id)
+
+
+def _add_broadcast_target(client_id, client_data):
+    """Adds (or replaces) a client in the broadcast list. Call with clients_lock held."""
+    global _broadcast_targets
+    _broadcast_targets = [t for t in _broadcast_targets if t[0] != client_id] + [(client_id, client_data)]
+
+
+def _remove_broadcast_target(client_id):
+    """Drops a client from the broadcast list. Call with clients_lock held."""
+    global _broadcast_targets
+    _broadcast_targets = [t for t in _broadcast_targets if t[0] != client_id]
+
+
+def _enqueue_spectator(client_id):
+    """Appends to spectators_waiting and records the rank. Call with queue_lock held."""
+    spectator_rank[client_id] = len(spectators_waiting)
+    spectators_waiting.append(client_id)
+
+
+def _dequeue_spectator(client_id):
+    """Removes from spectators_waiting, only renumbering the ones behind. Call with queue_lock held."""
+    idx = spectator_rank.pop(client_id)
+    del spectators_waiting[idx]
+    for i in range(idx, len(spectators_waiting)):
+        spectator_rank[spectators_waiting[i]] = i
 
 
 def broadcast_to_all(message, sender_id=None):
     """Broadcasts a message to all connected clients except the sender."""
     # print(f"[DEBUG] SERVER.PY: broadcast_to_all: Broadcasting message: '{message}'") # Too verbose
-    client_ids_to_send = []
-    with lock:
-        client_ids_to_send = list(clients.keys())
-
-    for client_id in client_ids_to_send:
+    # No lock needed, mutators swap in a new list so this one never changes under us
+    packet = None
+    for client_id, client_data in _broadcast_targets:
         if client_id != sender_id:
-            send_message_to_client(client_id, message)
-
-def get_client_username(conn, addr):
-    """Prompt the client for a username using the packet protocol. Returns None if not received."""
-    try:
-        # Send prompt as SYSTEM_MESSAGE packet
-        prompt_packet = pack_packet(0, SYSTEM_MESSAGE, b"Enter your username:")
-        conn.sendall(prompt_packet)
-
-        # Receive  response
-        result = receive_packet(conn)
-        if result is None:
-            print(f"[ERROR] SERVER.PY: get_client_username: No valid packet received from {addr}. Closing connection.")
-            return None
-
-        seq, pkt_type, payload = result
-        if pkt_type != USER_INPUT:
-            print(f"[ERROR] SERVER.PY: get_client_username: Expected USER_INPUT, got {pkt_type} from {addr}")
-            return None
-
-        username = payload.decode().strip()
-        if not username:
-            print(f"[ERROR] SERVER.PY: get_client_username: No username received or username empty from {addr}.")
-            return None
-        return username
-    except Exception as e:
-        print(f"[ERROR] SERVER.PY: get_client_username: Failed during packet-based username exchange: {e}")
-        return None
+            if packet is None:
+                packet = pack_packet(0, SYSTEM_MESSAGE, message.encode())
+            _enqueue_packet(client_id, client_data, packet)
 
 def broadcast_game_board_state(player1_board, player2_board):
     """Sends the current public board state to all spectators."""
-    # Format boards next tot each other
-    board_message = "GRID\n"
-    board_message += "PLAYER 1                  PLAYER 2\n"
-    separator_len = (BOARD_SIZE * 2) + 2 + len("    |    ") + (BOARD_SIZE * 2) + 2 # so that they are evenly spaced
-    board_message += "-" * (separator_len if separator_len > 0 else 40) + "\n" #min length
-
-    p1_grid = player1_board.display_grid
-    p2_grid = player2_board.display_grid
+    global _last_board_broadcast
+    # Same bytes for every spectator, so render + pack once. And if neither board changed since the
+    # last broadcast (repeat shot, reconnect), reuse that packet. Holding the boards themselves
+    # (not their ids) means a new game's boards can never match an old entry
+    cached = _last_board_broadcast
+    if (cached is not None and cached[0] is player1_board and cached[1] == player1_board.version
+            and cached[2] is player2_board and cached[3] == player2_board.version):
+        board_packet = cached[4]
+    else:
+        # Format boards next tot each other, collect the lines and join once instead of += per row.
+        # The rows themselves come from each board's own render cache
+        parts = list(_GRID_HEADER_LINES)
+        for p1_row, p2_row in zip(player1_board.render_rows(), player2_board.render_rows()):
+            parts.append(f"{p1_row}    |    {p2_row}")
+        board_message = "\n".join(parts) + "\n\n" # blank line = end of grid data
+        board_packet = pack_packet(0, SYSTEM_MESSAGE, board_message.encode())
+        _last_board_broadcast = (player1_board, player1_board.version, player2_board, player2_board.version, board_packet)
+
+    # Same copy-on-write snapshot broadcast_to_all uses, so no clients_lock and no temp list per shot.
+    # role is one dict read, a client changing role mid-loop just gets/misses this one board
+    for spec_id, spec_data in _broadcast_targets:
+        if spec_data.get("role") == "spectator":
+            _enqueue_packet(spec_id, spec_data, board_packet)
+    # print("[DEBUG] SERVER.PY: broadcast_game_board_state: Broadcasted game board state to spectators.")
 
-    for r_idx in range(BOARD_SIZE):
-        row_label = chr(ord('A') + r_idx)
 
-        row_p1 = " ".join(p1_grid[r_idx][c_idx] for c_idx in range(BOARD_SIZE))
-        row_p2 = " ".join(p2_grid[r_idx][c_idx] for c_idx in range(BOARD_SIZE))
+def _handle_help(client_id, args, client_role):
+    # Unknown role should not happen if role is set correctly
+    send_packet_to_client(client_id, _HELP_TEXT_PACKETS.get(client_role, _HELP_TEXT_PACKETS[None]))
 
-        board_message += f"{row_label:2} {row_p1}    |    {row_label:2} {row_p2}\n"
-    board_message += "\n" # end of grid data
 
-    with lock:
-        spectator_ids = [cid for cid, data in clients.items() if data.get("role") == "spectator"]
+def _handle_status(client_id, args, client_role):
+    if client_role == "player":
+        with game_lock: # Access game_in_progress state under lock
+            if game_in_progress:
+                send_message_to_client(client_id, "[SYSTEM] You are currently playing a game.")
+            else:
+                # Player role but game not in progress - very quick thing
+                send_message_to_client(client_id, "[SYSTEM] You are registered as a player. Waiting for the game to start.")
+    elif client_role == "spectator":
+        with queue_lock: # game_in_progress is just read as a hint here
+            try:
+                # Position in the combined waiting queue (players first, then spectators)
+                queue_length = len(players_waiting) + len(spectators_waiting)
+                rank = spectator_rank.get(client_id)
+                if rank is not None:
+                    position = len(players_waiting) + rank + 1
+                    send_message_to_client(client_id, f"[SYSTEM] You are #{position} in the queue.")
+                    if game_in_progress:
+                        remaining_in_queue = queue_length - position
+                        #  2 players per game
+                        games_to_wait = (remaining_in_queue + 1) // 2
+                        if games_to_wait == 0:
+                             send_message_to_client(client_id, "[SYSTEM] You will play in the next game!")
+                        else:
+                             send_message_to_client(client_id, f"[SYSTEM] You will need to wait for approximately {games_to_wait} more game(s).")
+                    else:
+                        # No game in progress, estimate games to wait based on current queue size by dividing
+                        estimated_games_in_queue = (queue_length + 1) // 2
+                        games_to_wait = max(0, estimated_games_in_queue - (position + 1) // 2)
 
-    for spec_id in spectator_ids:
-         send_message_to_client(spec_id, board_message)
-    # print("[DEBUG] SERVER.PY: broadcast_game_board_state: Broadcasted game board state to spectators.")
+                        if position <= 2:
+                            send_message_to_client(client_id, "[SYSTEM] You are next in line for the game!")
+                        else:
+                            # Crude estimate considering those who might become players first
+                            games_to_wait_further = (position - (len(players_waiting) + 1)) // 2 + 1 if len(players_waiting) < 2 else (position - 3) // 2 + 1 # rough estimate
+                            send_message_to_client(client_id, f"[SYSTEM] Waiting for enough players. You are #{position} in queue.")
 
 
-def handle_command(client_id, command):
-    """Handles commands received from clients."""
-    print(f"[DEBUG] SERVER.PY: handle_command: {client_id} issued command: {command}")
+                else:
+                     send_message_to_client(client_id, "[SYSTEM] Could not determine your position in the queue.")
+            except Exception as e:
+                log(f"[ERROR] SERVER.PY: handle_command: Error sending status to spectator {client_id}: {e}")
+
+
+def _handle_quit(client_id, args, client_role):
+    send_packet_to_client(client_id, _QUIT_PACKET)
+    # Signal to remove client - removal happens outside command handling to avoid issues
+    # Let the reactor detect the connection close after sending this
+    # Or we could put a special message in the queue/flag for the input worker
+    # For now, rely on connection close detection.
+    pass # Removal is handled by the thread detecting disconnection!!!!!! does nothing!!
+
+
+def _handle_chat(client_id, args, client_role):
+    if args:
+        # Format chat message and broadcast
+        # Use client ID as name
+        sender_info = client_id
+        if client_role:
+            sender_info = f"{client_role.capitalize()} {client_id}"
+        chat_message = f"[CHAT] {sender_info}: {args}"
+        broadcast_to_all(chat_message, sender_id=client_id)
+        log(f"[INFO] Chat from {client_id}: {args}")
+    else:
+        send_packet_to_client(client_id, _CHAT_USAGE_PACKET)
 
-    command_parts = command.lower().strip().split(maxsplit=1)
-    cmd = command_parts[0]
-    args = command_parts[1] if len(command_parts) > 1 else ""
 
-    client_role = None
-    with lock:
-        client_data = clients.get(client_id)
-        if client_data:
-            client_role = client_data.get("role")
-
-    if cmd == "/help":
-        if client_role == "player":
-            help_text = "Available commands: /help, /quit, /chat <message>"
-        elif client_role == "spectator":
-             help_text = "Available commands: /help, /quit, /status, /chat <message>"
-        else: # Should not happen if role is set correctly
-             help_text = "Available commands: /help, /quit (You are in a transitional state)"
-
-        send_message_to_client(client_id, f"[SYSTEM] {help_text}")
-
-    elif cmd == "/status":
-        if client_role == "player":
-            with lock: # Access game_in_progress state under lock
-                if game_in_progress:
-                    send_message_to_client(client_id, "[SYSTEM] You are currently playing a game.")
-                else:
-                    # Player role but game not in progress - very quick thing
-                    send_message_to_client(client_id, "[SYSTEM] You are registered as a player. Waiting for the game to start.")
-        elif client_role == "spectator":
-            with lock:
-                try:
-                    # Find position in the combined waiting queue
-                    combined_queue = players_waiting + spectators_waiting
-                    position = -1
-                    for i, cid in enumerate(combined_queue):
-                         if cid == client_id:
-                              position = i + 1
-                              break
-
-                    if position != -1:
-                        send_message_to_client(client_id, f"[SYSTEM] You are #{position} in the queue.")
-                        if game_in_progress:
-                            remaining_in_queue = len(combined_queue) - position
-                            #  2 players per game
-                            games_to_wait = (remaining_in_queue + 1) // 2
-                            if games_to_wait == 0:
-                                 send_message_to_client(client_id, "[SYSTEM] You will play in the next game!")
-                            else:
-                                 send_message_to_client(client_id, f"[SYSTEM] You will need to wait for approximately {games_to_wait} more game(s).")
-                        else:
-                            # No game in progress, estimate games to wait based on current queue size by dividing
-                            estimated_games_in_queue = (len(players_waiting) + len(spectators_waiting) + 1) // 2
-                            games_to_wait = max(0, estimated_games_in_queue - (position + 1) // 2)
+# {command word: handler(client_id, args, client_role)}
+_COMMAND_HANDLERS = {
+    "/help": _handle_help,
+    "/status": _handle_status,
+    "/quit": _handle_quit,
+    "/chat": _handle_chat,
+}
 
-                            if position <= 2:
-                                send_message_to_client(client_id, "[SYSTEM] You are next in line for the game!")
-                            else:
-                                # Crude estimate considering those who might become players first
-                                games_to_wait_further = (position - (len(players_waiting) + 1)) // 2 + 1 if len(players_waiting) < 2 else (position - 3) // 2 + 1 # rough estimate
-                                send_message_to_client(client_id, f"[SYSTEM] Waiting for enough players. You are #{position} in queue.")
 
+def handle_command(client_id, command, client_role):
+    """Handles commands received from clients. client_role is what handle_client_packet already read."""
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: handle_command: {client_id} issued command: {command}")
 
-                    else:
-                         send_message_to_client(client_id, "[SYSTEM] Could not determine your position in the queue.")
-                except Exception as e:
-                    print(f"[ERROR] SERVER.PY: handle_command: Error sending status to spectator {client_id}: {e}")
-
-
-    elif cmd == "/quit":
-        send_message_to_client(client_id, "[SYSTEM] You have chosen to quit. Disconnecting.")
-        # Signal to remove client - removal happens outside command handling to avoid issues
-        # Let the handle_client_input thread detect the connection close after sending this
-        # Or we could put a special message in the queue/flag for the handle_client_input thread
-        # For now, rely on connection close detection.
-        pass # Removal is handled by the thread detecting disconnection!!!!!! does nothing!!
-
-    elif cmd == "/chat":
-         if args:
-            # Format chat message and broadcast
-            # Use client ID as name
-            sender_info = client_id
-            with lock:
-                 client_data = clients.get(client_id)
-                 if client_data and client_data.get("role"):
-                     sender_info = f"{client_data['role'].capitalize()} {client_id}"
-            chat_message = f"[CHAT] {sender_info}: {args}"
-            broadcast_to_all(chat_message, sender_id=client_id)
-            print(f"[INFO] Chat from {client_id}: {args}")
-         else:
-             send_message_to_client(client_id, "[SYSTEM] Usage: /chat <your message>")
+    # Only the command word gets lowercased, input is already stripped by handle_client_packet
+    sp = command.find(" ")
+    if sp >= 0:
+        cmd = command[:sp].lower()
+        args = command[sp + 1:].strip()
+    else:
+        cmd = command.lower()
+        args = ""
 
+    handler = _COMMAND_HANDLERS.get(cmd)
+    if handler:
+        handler(client_id, args, client_role)
     else:
         send_message_to_client(client_id, f"[SYSTEM] Unknown command: {command}. Type /help for available commands.")
 
 
-def handle_client_input(client_id):
-    """Thread function to continuously read input from a client."""
-    print(f"[DEBUG] SERVER.PY: handle_client_input: handle_client_input thread started for {client_id}")
+def handle_client_packet(client_id, packet):
+    """Handles one packet of input from a registered client. Runs on the input worker."""
+    seq, pkt_type, payload = packet
+    # Strip the raw bytes first, blank packets get dropped without ever being decoded
+    payload = payload.strip()
+    if not payload:
+        return
+    line = payload.decode()
 
-    with lock:
-        client_data = clients.get(client_id)
-        conn = client_data["socket"] if client_data else None
-        if not conn:
-            print(f"[ERROR] SERVER.PY: handle_client_input started for unknown client_id {client_id}")
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: handle_client_packet: Received from {client_id}: '{line}'")
+
+    # Input Rate limiting check. No lock: only the input worker ever touches last_input_ns,
+    # and the rest are single reads (atomic under the GIL)
+    now_ns = time.monotonic_ns()
+    client_data = clients.get(client_id)
+    if client_data:
+        if now_ns - client_data['last_input_ns'] < INPUT_RATE_DELAY_NS:
+            send_packet_to_client(client_id, _RATE_LIMIT_PACKET)
             return
+        client_data['last_input_ns'] = now_ns
+
+    current_role = client_data.get("role") if client_data else None
+    player_input_queue = client_data.get("input_queue") if client_data else None
+    current_game_in_progress = game_in_progress
+
+    if line.startswith('/'):
+        handle_command(client_id, line, current_role)
+    else:
+        if current_role == "player" and current_game_in_progress and player_input_queue:
+            try:
+                if DEBUG_LOG: log(f"[DEBUG:handle_client_packet] Putting input '{line}' into {client_id}'s queue (Role: {current_role}, Game: {current_game_in_progress}).")
+                player_input_queue.put_nowait(line)
+            except queue.Full:
+                send_packet_to_client(client_id, _INPUT_QUEUE_FULL_PACKET)
+            except Exception as e:
+                log(f"[ERROR:handle_client_packet] Error putting input into {client_id}'s queue: {e}")
+                send_packet_to_client(client_id, _INPUT_ERROR_PACKET)
+        else:
+            sender_info = f"{current_role.capitalize()} {client_id}" if current_role else client_id
+            chat_message = f"[CHAT] {sender_info}: {line}"
+            broadcast_to_all(chat_message, sender_id=client_id)
+            log(f"[INFO] Chat from {client_id}: {line}")
+
 
+def _accept_client(sel, conn, addr):
+    """Sets up a just-accepted socket, asks for a username and hands it to the reactor (sel)."""
+    # Listener is non-blocking but clients aren't: the reactor only recv()s once select says there's
+    # data, and the writer thread wants a blocking sendall. Always set it: on BSD/macOS/Windows the
+    # accepted socket inherits O_NONBLOCK from our listener while gettimeout() still says None
+    conn.setblocking(True)
+    # Every send is already a whole message (or several in one sendmsg), so don't let Nagle hold it back
     try:
-        while True:
-            result = receive_packet(conn)
-            if not result:
-                print(f"[INFO] Client {client_id} disconnected (no packet received).")
-                break
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as e:
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: _accept_client: Could not set TCP_NODELAY for {addr}: {e}")
+    # Linux only: ack the username packet straight away instead of on the delayed-ACK timer
+    if hasattr(socket, "TCP_QUICKACK"):
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        except OSError:
+            pass
 
-            seq, pkt_type, payload = result
-            line = payload.decode().strip()
-            if not line:
-                continue
+    if not _conn_slots.acquire(blocking=False):
+        log(f"[INFO] Connection from {addr} refused. Max connections ({MAX_CONNECTIONS}) reached.")
+        try:
+            _send_nowait(conn, _MAX_CONNECTIONS_REFUSAL_BYTES)
+        except OSError:
+            pass
+        conn.close()
+        return
+
+    try:
+        _send_nowait(conn, _USERNAME_PROMPT_PACKET)
+    except Exception as e: # anything at all, or the slot and socket would leak
+        log(f"[ERROR] SERVER.PY: _accept_client: Failed to send username prompt to {addr}: {e}")
+        try: conn.close()
+        except: pass
+        _conn_slots.release()
+        return
+    _slot_socks[conn] = True
+
+    # The reply comes back through the reactor like any other packet, see _handle_username
+    state = {
+        "conn": conn,
+        "fd": conn.fileno(),
+        "addr": addr,
+        "reader": PacketReader(),
+        "client_id": None, # set once the username is accepted
+        "dropped": False, # we gave up on it, ignore anything still queued
+        "input_q": _input_qs[conn.fileno() % len(_input_qs)], # which input worker handles it
+    }
+    try:
+        sel.register(conn, selectors.EVENT_READ, data=state)
+    except KeyError:
+        # Some other thread closed a registered socket and the fd number got reused. Closing takes
+        # it out of epoll by itself, only the selector's bookkeeping is stale
+        sel.unregister(state["fd"])
+        sel.register(conn, selectors.EVENT_READ, data=state)
 
-            print(f"[DEBUG] SERVER.PY: handle_client_input: Received from {client_id}: '{line}'")
 
-            # Input Rate limiting check
-            current_time = time.time()
-            with lock:
-                client_data = clients.get(client_id)
-                if client_data:
-                    time_since_last_input = current_time - client_data['last_input_time']
-                    if time_since_last_input < INPUT_RATE_DELAY:
-                        send_message_to_client(client_id, "[SYSTEM] Input rate limit exceeded. Slow down.")
-                        continue
-                    client_data['last_input_time'] = current_time
-
-                current_role = client_data.get("role") if client_data else None
-                player_input_queue = client_data.get("input_queue") if client_data else None
-                current_game_in_progress = game_in_progress
-
-            if line.startswith('/'):
-                handle_command(client_id, line)
+def _read_client(sel, state):
+    """Reactor side: one recv() for a readable client socket, complete packets go to the input worker."""
+    try:
+        data = state["conn"].recv(RECV_SIZE)
+    except OSError: # reset, or closed under us by another thread
+        data = b""
+    packets = state["reader"].read_packets(data) if data else [None]
+    for packet in packets:
+        if packet is None: # EOF or a corrupted packet, either way this connection is done
+            key = sel.get_map().get(state["fd"])
+            if key is not None and key.data is state: # fd may already belong to someone else
+                sel.unregister(state["fd"])
+            state["input_q"].put((state, None))
+            return
+        state["input_q"].put((state, packet))
+
+
+def input_worker(input_q):
+    """Thread function that handles its share of the clients' packets, in the order the reactor read them."""
+    while True:
+        state, packet = input_q.get()
+        try:
+            if packet is None:
+                _client_input_closed(state)
+            elif state["dropped"]:
+                continue
+            elif state["client_id"] is None:
+                _handle_username(state, packet)
             else:
-                if current_role == "player" and current_game_in_progress and player_input_queue:
-                    try:
-                        print(f"[DEBUG:handle_client_input] Putting input '{line}' into {client_id}'s queue (Role: {current_role}, Game: {current_game_in_progress}).")
-                        player_input_queue.put_nowait(line)
-                    except queue.Full:
-                        send_message_to_client(client_id, "[SYSTEM] Input queue is full. Please wait a moment.")
-                    except Exception as e:
-                        print(f"[ERROR:handle_client_input] Error putting input into {client_id}'s queue: {e}")
-                        send_message_to_client(client_id, "[SYSTEM] An error occurred processing your input.")
-                else:
-                    sender_info = f"{current_role.capitalize()} {client_id}" if current_role else client_id
-                    chat_message = f"[CHAT] {sender_info}: {line}"
-                    broadcast_to_all(chat_message, sender_id=client_id)
-                    print(f"[INFO] Chat from {client_id}: {line}")
+                handle_client_packet(state["client_id"], packet)
+        except Exception as e:
+            log(f"[ERROR] SERVER.PY: input_worker: Error handling input for {state['client_id'] or state['addr']}: {e}")
+            _drop_client_input(state)
 
-    except Exception as e:
-        print(f"[ERROR] SERVER.PY: handle_client_input: Error in handle_client_input for {client_id}: {e}")
-    finally:
-        print(f"[DEBUG] SERVER.PY: handle_client_input: handle_client_input thread for {client_id} ending. Ensuring client removal.")
+
+def _drop_client_input(state):
+    # Shut it down and let the reactor see the EOF, so cleanup always goes through _client_input_closed
+    state["dropped"] = True
+    try: state["conn"].shutdown(socket.SHUT_RDWR)
+    except: pass
+
+
+def _handle_username(state, packet):
+    """First packet on a new connection: the username. Registers the client or drops the connection."""
+    seq, pkt_type, payload = packet
+    addr = state["addr"]
+    if pkt_type != USER_INPUT:
+        log(f"[ERROR] SERVER.PY: _handle_username: Expected USER_INPUT, got {pkt_type} from {addr}")
+        _drop_client_input(state)
+        return
+
+    username = payload.decode().strip()
+    if not username:
+        log(f"[ERROR] SERVER.PY: _handle_username: No username received or username empty from {addr}.")
+        _drop_client_input(state)
+        return
+
+    client_id = handle_new_connection(state["conn"], addr, username)
+    if client_id is None:
+        state["dropped"] = True # Refused, handle_new_connection already closed it (and gave the slot back)
+    else:
+        state["client_id"] = client_id
+
+
+def _release_conn_slot(sock):
+    """Gives sock's connection slot back. Called from every path that ends a connection (EOF from the
+    reactor, and each place we close a socket ourselves, since a closed fd just drops out of epoll and
+    never reports EOF). Only the first call per socket does anything."""
+    if _slot_socks.pop(sock, None):
+        _conn_slots.release()
+
+
+def _close_socket(sock):
+    """close() plus giving back its connection slot."""
+    try: sock.close()
+    except: pass
+    _release_conn_slot(sock)
+
+
+def _client_input_closed(state):
+    """The reactor saw this connection end (EOF, reset, corrupt packet). Replaces what used to be the
+    end of each client's input thread."""
+    # Peer is gone even if we keep the socket around a bit longer (disconnected player waiting to reconnect)
+    _release_conn_slot(state["conn"])
+    client_id = state["client_id"]
+    if client_id is None: # Never got as far as a username
+        _close_socket(state["conn"])
+        return
+    log(f"[INFO] Client {client_id} disconnected (no packet received).")
+    # A reconnect may have already given them a new socket, don't remove that one
+    client_data = clients.get(client_id)
+    if client_data and client_data.get("socket") is state["conn"]:
         remove_client(client_id)
-        print(f"[DEBUG] SERVER.PY: handle_client_input: Client input thread for {client_id} finished.")
+
 
 def remove_client(client_id):
-    print(f"[DEBUG] SERVER.PY: remove_client: Attempting to remove client {client_id}")
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: remove_client: Attempting to remove client {client_id}")
 
-    with lock:
+    with all_locks():
         client_data = clients.get(client_id)
+        # Dead or leaving either way, so stop broadcasting to them
+        _remove_broadcast_target(client_id)
         # If client is a player in an active game, mark as disconnected instead of full removal
         if client_id in active_games and active_games[client_id].get("disconnected") is False:
-            print(f"[DEBUG] SERVER.PY: remove_client: {client_id} is a player in an active game. Marking as disconnected.")
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: remove_client: {client_id} is a player in an active game. Marking as disconnected.")
             mark_player_disconnected(client_id, active_games)
             return  # Do not fully remove YET
 
         # Remove from waiting queues if present
-        if client_id in players_waiting:
+        # spectator_rank already gives O(1) membership for the spectator queue, and
+        # players_waiting never holds more than 2 ids, so just remove in one scan
+        try:
             players_waiting.remove(client_id)
-            print(f"[DEBUG] SERVER.PY: remove_client: Removed {client_id} from players_waiting.")
-        if client_id in spectators_waiting:
-            spectators_waiting.remove(client_id)
-            print(f"[DEBUG] SERVER.PY: remove_client: Removed {client_id} from spectators_waiting.")
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: remove_client: Removed {client_id} from players_waiting.")
+        except ValueError:
+            pass
+        if client_id in spectator_rank:
+            _dequeue_spectator(client_id)
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: remove_client: Removed {client_id} from spectators_waiting.")
 
         # Check if this client was one of the players in the active game
         if game_in_progress and game_thread and game_thread.is_alive():
@@ -325,44 +813,68 @@ def remove_client(client_id):
 
 
         else:
-            print(f"[DEBUG] SERVER.PY: remove_client: Client {client_id} not found in clients dictionary during removal attempt.")
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: remove_client: Client {client_id} not found in clients dictionary during removal attempt.")
 
 
     if client_data:
         # Close file objects and socket outside the lock
-        sock = client_data.get("socket")
-        if client_data.get("r") and not client_data["r"].closed:
-            try: client_data["r"].close()
-            except: pass
-        if client_data.get("w") and not client_data["w"].closed:
-            try: client_data["w"].close()
-            except: pass
-        if sock:
-            try: sock.close()
-            except: pass
+        _close_client_connection(client_data)
 
 
     # Update spectator positions after removal if the removal affected the queue
-    with lock:
-        # Update positions if the removal affected the queue length
-        # Any removal *cOULD* affect positions
-        print(f"[DEBUG] SERVER.PY: remove_client: Client removal occurred. Updating spectator positions.")
-        update_spectator_positions()
+    # Any removal *cOULD* affect positions
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: remove_client: Client removal occurred. Scheduling spectator position update.")
+    positions_dirty.set()
 
-    print(f"[DEBUG] SERVER.PY: remove_client: remove_client finished for {client_id}")
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: remove_client: remove_client finished for {client_id}")
     # Check if game should start if enough players are waiting
     # This might be redundant if run_game_wrapper calls check_start_game, but ensures
     # a game starts if players disconnect before a game starts
-    check_start_game()
+    matchmaking_dirty.set()
+
+
+def _close_client_connection(client_data):
+    """Flush a client's outbox and close its socket. Safe to call without the lock."""
+    dead = client_data.get("dead")
+    # Flush so e.g. the /quit goodbye still gets out, unless we already know nobody's listening
+    _stop_client_writer(client_data, 0 if dead else CLOSE_FLUSH_TIMEOUT)
+    # No makefile() objects to close anymore, the socket is all there is (reactor reads, writer sends)
+    sock = client_data.get("socket")
+    if sock:
+        if dead:
+            # Send failed or it stopped reading: abortive close (RST), don't leave unsendable
+            # data and a FIN handshake hanging around in the kernel
+            try: sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _LINGER_ABORT)
+            except: pass
+        # shutdown first: close() alone won't send FIN if another thread still has the fd in a recv/send
+        try: sock.shutdown(socket.SHUT_RDWR)
+        except: pass
+        _close_socket(sock)
+
+
+def spectator_position_worker():
+    """Background thread that sends ONE position update per burst of queue changes.
+
+    Callers just set positions_dirty. A game ending fires remove/recycle/promote back to back,
+    so we wait a moment for the burst to settle instead of sending everyone 3 updates.
+    """
+    while True:
+        positions_dirty.wait()
+        time.sleep(POSITION_UPDATE_DELAY)  # coalescing window
+        positions_dirty.clear()
+        try:
+            _do_update_spectator_positions()
+        except Exception as e:
+            log(f"[ERROR] SERVER.PY: spectator_position_worker: Error updating positions: {e}")
 
 
-def update_spectator_positions():
+def _do_update_spectator_positions():
     """Informs spectators about their updated position in the queue."""
-    print(f"[DEBUG] SERVER.PY: update_spectator_positions: update_spectator_positions called.")
-    with lock:
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: _do_update_spectator_positions: _do_update_spectator_positions called.")
+    with queue_lock:
         # Combine players_waiting and spectators_waiting to get total queue
-        current_queue = players_waiting + spectators_waiting
-        # print(f"[DEBUG] SERVER.PY: update_spectator_positions: Current queue: {current_queue}") # Too verbose
+        # Walk both lists in place instead of building players_waiting + spectators_waiting
+        current_queue = itertools.chain(players_waiting, spectators_waiting)
 
         messages_to_send = [] # List of (client_id, message)
 
@@ -379,20 +891,21 @@ def update_spectator_positions():
                     messages_to_send.append((client_id, message))
 
                 except Exception as e:
-                    print(f"[ERROR] SERVER.PY: update_spectator_positions: Error preparing position update for {client_id}: {e}")
+                    log(f"[ERROR] SERVER.PY: _do_update_spectator_positions: Error preparing position update for {client_id}: {e}")
                     # client might be disconnecting, handle removal later!!!!
 
-        # Send messages outside lock if  needed
-        for client_id, message in messages_to_send:
-             send_message_to_client(client_id, message)
+    # Send messages outside lock
+    for client_id, message in messages_to_send:
+         send_message_to_client(client_id, message)
 
-    print(f"[DEBUG] SERVER.PY: update_spectator_positions: update_spectator_positions finished.")
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: _do_update_spectator_positions: _do_update_spectator_positions finished.")
 
 
 def recycle_players_to_spectators(game_player_ids):
     """Moves players from the just-finished game back to the spectator queue."""
-    print(f"[DEBUG] SERVER.PY: recycle_players_to_spectators: Recycling players {game_player_ids} to spectators called.")
-    with lock:
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: recycle_players_to_spectators: Recycling players {game_player_ids} to spectators called.")
+    failed_ids = [] # removed after we let go of the locks, remove_client takes them itself
+    with clients_lock, queue_lock:
         recycled_count = 0
         for player_id in game_player_ids:
             client_data = clients.get(player_id)
@@ -402,163 +915,161 @@ def recycle_players_to_spectators(game_player_ids):
                     # Close the socket outside the lock if it exists
                     sock = client_data.get("socket")
                     if sock:
-                        try:
-                            sock.close()
-                        except:
-                            pass
+                        _close_socket(sock)
                     try:
                         send_message_to_client(player_id, "[SYSTEM] Game has ended. You are being returned to the spectator queue.")
                         client_data["role"] = "spectator" # Change role
                         client_data.pop("input_queue", None) # Remove player-specific queue
-                        spectators_waiting.append(player_id) # Add back to waiting list
+                        _enqueue_spectator(player_id) # Add back to waiting list
                         recycled_count += 1
-                        print(f"[INFO] Recycled {player_id} to spectators queue.")
+                        log(f"[INFO] Recycled {player_id} to spectators queue.")
                     except Exception as e:
                          # If sending fails here, they are effectively disconnected
-                        print(f"[INFO] Player {player_id} connection issue during recycling: {e}. Not recycling to queue.")
-                        remove_client(player_id) # Ensure removal
+                        log(f"[INFO] Player {player_id} connection issue during recycling: {e}. Not recycling to queue.")
+                        failed_ids.append(player_id) # Ensure removal
                 else:
-                    print(f"[INFO] Player {player_id} already disconnected. Not recycling.")
-                    # No need to call remove_client here, handle_client_input thread should have done it
+                    log(f"[INFO] Player {player_id} already disconnected. Not recycling.")
+                    # No need to call remove_client here, the input worker should have done it
                     # or it will be cleaned up by removing from clients dict.
 
         # Note: Disconnected players are not added back to spectators_waiting.
         # remove_client handles their removal from clients and existing waiting lists.
 
-        print(f"[DEBUG] SERVER.PY: recycle_players_to_spectators: {recycled_count} players recycled.")
-        print(f"[DEBUG] SERVER.PY: recycle_players_to_spectators: Players waiting after recycling: {players_waiting}")
-        print(f"[DEBUG] SERVER.PY: recycle_players_to_spectators: Spectators waiting after recycling: {spectators_waiting}")
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: recycle_players_to_spectators: {recycled_count} players recycled.")
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: recycle_players_to_spectators: Players waiting after recycling: {players_waiting}")
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: recycle_players_to_spectators: Spectators waiting after recycling: {spectators_waiting}")
         # Update positions for those remaining in queue
-        update_spectator_positions()
-    print(f"[DEBUG] SERVER.PY: recycle_players_to_spectators: recycle_players_to_spectators finished.")
+        positions_dirty.set()
+    for player_id in failed_ids:
+        remove_client(player_id)
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: recycle_players_to_spectators: recycle_players_to_spectators finished.")
 
 
 def promote_spectators_to_players():
-    """Promotes the first two eligible clients from the waiting queue to players."""
-    print(f"[DEBUG] SERVER.PY: promote_spectators_to_players: promote_spectators_to_players called.")
+    """Promotes the first two eligible clients from the waiting queue to players. Call with all_locks() held."""
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: promote_spectators_to_players: promote_spectators_to_players called.")
     promoted = False
     players_for_game = [] # Store client_ids of promoted players
-
-    with lock:
-        # Combine and filter for clients that are still connected
-        combined_queue = players_waiting + spectators_waiting
-        eligible_clients_ids = [cid for cid in combined_queue if cid in clients and clients[cid].get("socket")]
-        # Check if connection is active^^
-
-        print(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Eligible clients in queue: {eligible_clients_ids}")
-
-        if len(eligible_clients_ids) >= 2:
-            print(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Enough eligible clients ({len(eligible_clients_ids)}) to promote two.")
-            # Promote the first two eligible clients
-            players_for_game = eligible_clients_ids[:2]
-
-            # Remove promoted players from the waiting queues and update clients dict
-            for player_id in players_for_game:
-                # Remove from queue they were in
-                if player_id in players_waiting:
-                    players_waiting.remove(player_id)
-                elif player_id in spectators_waiting:
-                    spectators_waiting.remove(player_id)
-
-                # Update client
-                client_data = clients.get(player_id)
-                if client_data:
-                    client_data["role"] = "player"
-                    client_data["input_queue"] = queue.Queue() # Create a new input queue for the game
-                    # last_input_time already exists from when they connected
-                    print(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Promoted {player_id} to player role and assigned new queue.")
-                else:
-                    print(f"[ERROR] SERVER.PY: promote_spectators_to_players: Promoted client {player_id} not found in clients dict during role update.")
-                    # TO FIX This is a critical issue, ideally shouldn't happen if eligible_clients_ids was correct.
-                    # Remove this client from the list of players for the game.
-                    if player_id in players_for_game: players_for_game.remove(player_id)
+    promoted_data = [] # and their client data, handed straight to check_start_game
+
+    # Combine and filter for clients that are still connected
+    # Only ever need the first two, so stop scanning (and don't copy the queues) once we have them
+    combined_queue = itertools.chain(players_waiting, spectators_waiting)
+    eligible_clients_ids = list(itertools.islice(
+        (cid for cid in combined_queue if cid in clients and clients[cid].get("socket")), 2))
+    # Check if connection is active^^
+
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Eligible clients in queue: {eligible_clients_ids}")
+
+    if len(eligible_clients_ids) >= 2:
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Enough eligible clients ({len(eligible_clients_ids)}) to promote two.")
+        # Promote the first two eligible clients
+        players_for_game = eligible_clients_ids[:2]
+
+        # Remove promoted players from the waiting queues and update clients dict
+        for player_id in players_for_game:
+            # Remove from queue they were in
+            if player_id in players_waiting:
+                players_waiting.remove(player_id)
+            elif player_id in spectator_rank:
+                _dequeue_spectator(player_id)
+
+            # Update client
+            client_data = clients.get(player_id)
+            if client_data:
+                client_data["role"] = "player"
+                client_data["input_queue"] = PlayerInputQueue(PLAYER_INPUT_QUEUE_SIZE) # Create a new input queue for the game
+                promoted_data.append(client_data)
+                # last_input_ns already exists from when they connected
+                if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Promoted {player_id} to player role and assigned new queue.")
+            else:
+                log(f"[ERROR] SERVER.PY: promote_spectators_to_players: Promoted client {player_id} not found in clients dict during role update.")
+                # TO FIX This is a critical issue, ideally shouldn't happen if eligible_clients_ids was correct.
+                # Remove this client from the list of players for the game.
+                if player_id in players_for_game: players_for_game.remove(player_id)
 
 
-            if len(players_for_game) == 2:
-                 promoted = True
-                 print(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Successfully promoted {players_for_game[0]} and {players_for_game[1]} to players for the next game.")
+        if len(players_for_game) == 2:
+             promoted = True
+             if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Successfully promoted {players_for_game[0]} and {players_for_game[1]} to players for the next game.")
 
-                 try:
-                    # Inform the new players
-                    send_message_to_client(players_for_game[0], f"[SYSTEM] You are {players_for_game[0]} in the new game. Preparing to start...")
-                    send_message_to_client(players_for_game[1], f"[SYSTEM] You are {players_for_game[1]} in the new game. Preparing to start...")
-                 except Exception as e:
-                     print(f"[ERROR] SERVER.PY: promote_spectators_postions: Error informing new players after promotion: {e}")
-                     # If we can't message a new player, they are probablty disconnected.
-                     # The game wrapper will need to handle this if it starts.
-                     pass
+             try:
+                # Inform the new players
+                send_message_to_client(players_for_game[0], f"[SYSTEM] You are {players_for_game[0]} in the new game. Preparing to start...")
+                send_message_to_client(players_for_game[1], f"[SYSTEM] You are {players_for_game[1]} in the new game. Preparing to start...")
+             except Exception as e:
+                 log(f"[ERROR] SERVER.PY: promote_spectators_postions: Error informing new players after promotion: {e}")
+                 # If we can't message a new player, they are probablty disconnected.
+                 # The game wrapper will need to handle this if it starts.
+                 pass
 
 
-            else:
-                print(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Failed to get exactly two eligible players after processing ({len(players_for_game)} found).")
-                # If we promoted less than 2, put the ones we did promote back to spectator role/queue?
-                # Or just rely on the game wrapper failing to start with < 2 players.
-                # rely on the wrapper for now.
-                players_for_game = [] # Reset if not exactly two promoted
-                promoted = False
+        else:
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Failed to get exactly two eligible players after processing ({len(players_for_game)} found).")
+            # If we promoted less than 2, put the ones we did promote back to spectator role/queue?
+            # Or just rely on the game wrapper failing to start with < 2 players.
+            # rely on the wrapper for now.
+            players_for_game = [] # Reset if not exactly two promoted
+            promoted_data = []
+            promoted = False
 
 
-            # Update positions for remaining spectators in the queue
-            update_spectator_positions()
+        # Update positions for remaining spectators in the queue
+        positions_dirty.set()
 
-        else:
-            print(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Not enough eligible clients ({len(eligible_clients_ids)}) to promote.")
+    else:
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Not enough eligible clients ({len(eligible_clients_ids)}) to promote.")
 
-        print(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Players for next game: {[p for p in players_for_game]}") # Print the list directly
-        print(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Players waiting after promotion attempt: {players_waiting}")
-        print(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Spectators waiting after promotion attempt: {spectators_waiting}")
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Players for next game: {[p for p in players_for_game]}") # Print the list directly
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Players waiting after promotion attempt: {players_waiting}")
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: promote_spectators_to_players: Spectators waiting after promotion attempt: {spectators_waiting}")
 
-    print(f"[DEBUG] SERVER.PY: promote_spectators_to_players: promote_spectators_to_players finished. Promoted: {promoted}")
-    return promoted, players_for_game
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: promote_spectators_to_players: promote_spectators_to_players finished. Promoted: {promoted}")
+    return promoted, promoted_data
 
 
 def run_game_countdown():
     """Runs the countdown before a game starts."""
-    print(f"[DEBUG] SERVER.PY: run_game_countdown: run_game_countdown called.")
-    # Ensure clients list is stable during broadcast by taking snapshot in time!
-    client_ids_at_countdown_start = []
-    with lock:
-         client_ids_at_countdown_start = list(clients.keys())
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: run_game_countdown: run_game_countdown called.")
+    # Snapshot the recipients ONCE so every tick is just N writes (no lock, no dict lookups)
+    with clients_lock:
+        recipients = [(cid, data) for cid, data in clients.items() if data.get("outbox")]
+
+    def send_tick(packet):
+        for client_id, client_data in recipients:
+            _enqueue_packet(client_id, client_data, packet)
 
     for i in range(GAME_START_COUNTDOWN, 0, -1):
-        message = f"[SYSTEM] New game starting in {i} seconds..."
-        # print(f"[DEBUG] SERVER.PY: run_game_countdown: Countdown: {message}") # Too verbose
-        # Broadcast to all currently connected clients
-        broadcast_to_all(message) # broadcast_to_all handles disconnects
+        # print(f"[DEBUG] SERVER.PY: run_game_countdown: Countdown: {i}") # Too verbose
+        packet = _COUNTDOWN_PACKETS.get(i)
+        if packet is None: # GAME_START_COUNTDOWN got raised at runtime
+            packet = pack_packet(0, SYSTEM_MESSAGE, f"[SYSTEM] New game starting in {i} seconds...".encode())
+        send_tick(packet)
         time.sleep(1)
-    broadcast_to_all("[SYSTEM] Game is starting now!")
-    print(f"[DEBUG] SERVER.PY: run_game_countdown: Countdown finished. Game start message sent.")
+    send_tick(_GAME_STARTING_NOW_PACKET)
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: run_game_countdown: Countdown finished. Game start message sent.")
 
 
 def check_start_game():
     """Checks if a new game can be started and initiates it."""
     global game_in_progress, game_thread
-    print(f"[DEBUG] SERVER.PY: check_start_game: check_start_game called.")
-    with lock:
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: check_start_game: check_start_game called.")
+    new_game_thread = None
+    with all_locks():
         if game_in_progress:
-            print(f"[DEBUG] SERVER.PY: check_start_game: Game already in progress. Skipping check_start_game.")
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: check_start_game: Game already in progress. Skipping check_start_game.")
             return
 
-        # Try to promote players from the waiting queue
+        # Try to promote players from the waiting queue (expects us to hold all the locks)
+        # Only returns data for clients it just set to role "player" and gave an input queue,
+        # and we still hold the locks, so no need to look them up and re-check here
         promoted, players_for_game = promote_spectators_to_players()
 
         if promoted:
-            print(f"[DEBUG] SERVER.PY: check_start_game: Two players ({players_for_game[0]}, {players_for_game[1]}) are ready for a new game.")
+            player1_data, player2_data = players_for_game
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: check_start_game: Two players ({player1_data['id']}, {player2_data['id']}) are ready for a new game.")
             game_in_progress = True
-            print(f"[DEBUG] SERVER.PY: check_start_game: game_in_progress set to {game_in_progress}.")
-
-            # Get the client data and input queues for the players
-            player1_data = clients.get(players_for_game[0])
-            player2_data = clients.get(players_for_game[1])
-
-            # Double check if player data is still valid (e.g., not removed between promote and here)
-            if not player1_data or player1_data.get("role") != "player" or not player2_data or player2_data.get("role") != "player":
-                 print(f"[ERROR] SERVER.PY: check_start_game: Promoted player data became invalid before starting game. Cannot start game.")
-                 game_in_progress = False # Reset flag
-                 # Requeue or drop these clients? For now, let remove_client handle it, but should probs fix later
-                 # Re-check for next game opportunities.
-                 check_start_game()
-                 return
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: check_start_game: game_in_progress set to {game_in_progress}.")
 
             # Init active_games for reconnection
             active_games[player1_data['id']] = {
@@ -574,46 +1085,63 @@ def check_start_game():
                 "opponent": player1_data['id'],
             }
 
-            print(f"[DEBUG] SERVER.PY: check_start_game: Broadcasting game start.")
-            broadcast_to_all("[SYSTEM] A new game is starting!")
-            print(f"[DEBUG] SERVER.PY: check_start_game: Broadcasting successful.")
-
-            # start the game thread
-            print(f"[DEBUG] SERVER.PY: check_start_game: Starting run_game_wrapper thread.")
-            game_thread = threading.Thread(
+            # Just the Thread object in here (game_thread is guarded by game_lock), game_in_progress
+            # already keeps anyone else from starting a second game. start() and the broadcast happen
+            # after the locks are released so joins/inputs don't wait on pthread_create
+            game_thread = new_game_thread = threading.Thread(
                 target=run_game_wrapper,
                 args=(player1_data, player2_data),
                 daemon=True
             )
-            game_thread.start()
-            print(f"[DEBUG] SERVER.PY: check_start_game: Game wrapper thread started.")
         else:
-            print(f"[DEBUG] SERVER.PY: check_start_game: Not enough eligible clients to start a game. Waiting.")
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: check_start_game: Not enough eligible clients to start a game. Waiting.")
             # Inform waiting players/spectators if the game just ended and not enough players for next
             # Hhandled by run_game_wrapper's cleanup.
 
+    if new_game_thread:
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: check_start_game: Broadcasting game start.")
+        broadcast_to_all("[SYSTEM] A new game is starting!")
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: check_start_game: Broadcasting successful.")
+
+        # start the game thread
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: check_start_game: Starting run_game_wrapper thread.")
+        # No cyclic GC pauses mid-game, refcounting still frees the per-packet garbage.
+        # run_game_wrapper turns it back on once the game is over
+        gc.disable()
+        try:
+            new_game_thread.start()
+        except Exception:
+            gc.enable() # run_game_wrapper is what turns it back on, and it's never going to run
+            raise
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: check_start_game: Game wrapper thread started.")
+
+
+def matchmaker_worker():
+    """Background thread, the only caller of check_start_game. Joins, leaves and game ends just set
+    matchmaking_dirty, so the input worker/timer thread never does matchmaking inline."""
+    while True:
+        matchmaking_dirty.wait()
+        matchmaking_dirty.clear() # Before checking, so a change during the check gets another pass
+        try:
+            check_start_game()
+        except Exception as e:
+            log(f"[ERROR] SERVER.PY: matchmaker_worker: Error checking for a new game: {e}")
+
 
 def run_game_wrapper(player1_data, player2_data):
     """Wrapper to run the game and handle post-game cleanup."""
     global game_in_progress, game_thread
-    print(f"[DEBUG] SERVER.PY: run_game_wrapper: run_game_wrapper started with players {player1_data['id']} and {player2_data['id']}.")
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: run_game_wrapper: run_game_wrapper started with players {player1_data['id']} and {player2_data['id']}.")
 
     player_ids_in_game = [player1_data['id'], player2_data['id']]
-
-    # Ensure player roles are correctly set for the duration of the game
-    with lock:
-        p1_client_data = clients.get(player1_data['id'])
-        p2_client_data = clients.get(player2_data['id'])
-        if p1_client_data: p1_client_data["role"] = "player"
-        if p2_client_data: p2_client_data["role"] = "player"
-
+    # Roles were already set to "player" by promote_spectators_to_players
 
     try:
         # Run the countdown first
         run_game_countdown()
 
         # Run the actual game logic
-        print(f"[DEBUG] SERVER.PY: run_game_wrapper: Calling run_multiplayer_game...")
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: run_game_wrapper: Calling run_multiplayer_game...")
         run_multiplayer_game(
             player1_data,
             player2_data,
@@ -622,11 +1150,11 @@ def run_game_wrapper(player1_data, player2_data):
             send_message_to_client, # Pass server send function
             broadcast_game_board_state # Pass server board broadcast function
         )
-        print(f"[DEBUG] SERVER.PY: run_game_wrapper: run_multiplayer_game finished without exception.")
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: run_game_wrapper: run_multiplayer_game finished without exception.")
 
     except PlayerDisconnectedException as e:
-         print(f"[GAME INFO] Game ended due to player disconnection: {e}")
-         # The handle_client_input thread already called remove_client.
+         log(f"[GAME INFO] Game ended due to player disconnection: {e}")
+         # The input worker already called remove_client.
          disconnected_player_id = None # Need to determine which player disconnected
          if str(e).startswith(player1_data['id']): disconnected_player_id = player1_data['id']
          elif str(e).startswith(player2_data['id']): disconnected_player_id = player2_data['id']
@@ -644,47 +1172,48 @@ def run_game_wrapper(player1_data, player2_data):
 
 
     except PlayerTimeoutException as e:
-         print(f"[GAME INFO] Game ended due to player timeout/forfeit: {e}")
+         log(f"[GAME INFO] Game ended due to player timeout/forfeit: {e}")
          # Game logic already sent forfeit messages, just broadcast general end message
          broadcast_to_all(f"[SYSTEM] The game has ended because a player timed out/forfeited.")
 
     except Exception as e:
-        print(f"[ERROR] SERVER.PY: run_game_wrapper: Exception caught in run_game_wrapper during game execution: {type(e).__name__}: {e}")
+        log(f"[ERROR] SERVER.PY: run_game_wrapper: Exception caught in run_game_wrapper during game execution: {type(e).__name__}: {e}")
         broadcast_to_all(f"[SYSTEM] The game ended due to an unexpected server error: {type(e).__name__}")
     finally:
-        print(f"[DEBUG] SERVER.PY: run_game_wrapper: Game execution finished or errored. Starting cleanup.")
-        with lock:
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: run_game_wrapper: Game execution finished or errored. Starting cleanup.")
+        with game_lock:
             game_in_progress = False
             game_thread = None # Clear the game thread reference
-            print(f"[DEBUG] SERVER.PY: run_game_wrapper: game_in_progress set to {game_in_progress}.")
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: run_game_wrapper: game_in_progress set to {game_in_progress}.")
 
-        time.sleep(1) # Give a moment for final messages/cleanup
+        # Recycling closes the players' sockets, so let their final game messages get written first.
+        # Usually that's a few ms, not the full second we used to sleep
+        _wait_for_outboxes(player_ids_in_game, CLOSE_FLUSH_TIMEOUT)
 
-        print(f"[DEBUG] SERVER.PY: run_game_wrapper: Recycling players {player_ids_in_game}.")
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: run_game_wrapper: Recycling players {player_ids_in_game}.")
         recycle_players_to_spectators(player_ids_in_game)
-        print(f"[DEBUG] SERVER.PY: run_game_wrapper: Running garbage collection.")
-        gc.collect()
-        print(f"[DEBUG] SERVER.PY: run_game_wrapper: Broadcasting preparation for next match.")
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: run_game_wrapper: Re-enabling garbage collection.")
+        # Disabled by check_start_game for the game's duration. No forced full collect here,
+        # the normal generational thresholds pick up whatever the game left behind
+        gc.enable()
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: run_game_wrapper: Broadcasting preparation for next match.")
         broadcast_to_all("[SYSTEM] The current game has ended. Preparing for the next match...")
-        print(f"[DEBUG] SERVER.PY: run_game_wrapper: Checking if next game can start.")
-        check_start_game() # Check if theres enough players for the next game
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: run_game_wrapper: Checking if next game can start.")
+        matchmaking_dirty.set() # Check if theres enough players for the next game
 
 
 def mark_player_disconnected(client_id, active_games):
     """Mark a player as disconnected and start a reconnection timer with countdown messages."""
     global disconnected_players
 
-    print(f"[INFO] Marking player {client_id} as disconnected. Starting reconnection timer.")
+    log(f"[INFO] Marking player {client_id} as disconnected. Starting reconnection timer.")
 
     player_data = clients.get(client_id)
     if not player_data:
-        print(f"[WARN] Tried to mark unknown player {client_id} as disconnected.")
+        log(f"[WARN] Tried to mark unknown player {client_id} as disconnected.")
         return
 
-    opponent_id = active_games.get(client_id, {}).get("opponent")
-    opponent_data = clients.get(opponent_id) if opponent_id else None
-
-    # Store in the disconnected_players dict BEFORE starting the thread
+    # Store in the disconnected_players dict BEFORE scheduling the countdown
     disconnected_players[client_id] = {"player_data": player_data}
 
     # Optionally, mark in player_data that they're disconnected
@@ -692,302 +1221,367 @@ def mark_player_disconnected(client_id, active_games):
 
     if client_id in active_games:
         active_games[client_id]["disconnected"] = True
-        active_games[client_id]["reconnect_deadline"] = time.time() + RECONNECT_TIMEOUT
-
-    def countdown_and_remove():
-        remaining = RECONNECT_TIMEOUT
-        while remaining > 0:
-            print(f"\n[DEBUG] SERVER.PY: ----------countdown_and_remove called--------------------")
-            print(f"[DEBUG] SERVER.PY Countdown running for {client_id}: {remaining} seconds left")
-            if client_id not in disconnected_players or not active_games[client_id].get("disconnected", True):
-                print(f"[INFO] Countdown stopped: {client_id} has reconnected.")
-                return
-            try:
-                send_message_to_client(client_id, f"[SYSTEM] Reconnect within {remaining} seconds or you will forfeit!")
-            except Exception as e:
-                print(f"[DEBUG] Countdown send_message_to_client failed for {client_id}: {e}")
+        active_games[client_id]["reconnect_deadline"] = time.monotonic() + RECONNECT_TIMEOUT # monotonic, a clock step can't stretch/cut the window
+
+    # First countdown message goes out right away, then one a second (see reconnect_timer_worker)
+    _schedule_reconnect_tick(time.monotonic(), client_id, RECONNECT_TIMEOUT, disconnected_players[client_id])
+
+
+def _schedule_reconnect_tick(due, client_id, remaining, entry):
+    with _reconnect_cv:
+        heapq.heappush(_reconnect_ticks, (due, next(_reconnect_seq), client_id, remaining, entry))
+        _reconnect_cv.notify()
+
+
+def reconnect_timer_worker():
+    """Background thread that runs every disconnected player's reconnect countdown."""
+    while True:
+        with _reconnect_cv:
+            while True:
+                delay = _reconnect_ticks[0][0] - time.monotonic() if _reconnect_ticks else None
+                if delay is not None and delay <= 0:
+                    break
+                _reconnect_cv.wait(delay)
+            due, _, client_id, remaining, entry = heapq.heappop(_reconnect_ticks)
+        try:
+            _reconnect_tick(due, client_id, remaining, entry)
+        except Exception as e:
+            log(f"[ERROR] SERVER.PY: reconnect_timer_worker: Error in countdown for {client_id}: {e}")
+
+
+def _reconnect_tick(due, client_id, remaining, entry):
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY Countdown running for {client_id}: {remaining} seconds left")
+    # A reconnect pops the entry (and a later disconnect makes a new one), either way this countdown is over
+    if disconnected_players.get(client_id) is not entry or not active_games.get(client_id, {}).get("disconnected", True):
+        log(f"[INFO] Countdown stopped: {client_id} has reconnected.")
+        return
+    if remaining > 0:
+        send_message_to_client(client_id, f"[SYSTEM] Reconnect within {remaining} seconds or you will forfeit!")
+        opponent_id = active_games.get(client_id, {}).get("opponent")
+        if opponent_id and clients.get(opponent_id):
+            send_message_to_client(opponent_id, f"[SYSTEM] Opponent has {remaining} seconds to reconnect or you will win by forfeit.")
+        _schedule_reconnect_tick(due + 1, client_id, remaining - 1, entry)
+        return
+    log(f"[INFO] Player {client_id} did not reconnect in time. Removing from game.")
+    broadcast_to_all("[SYSTEM] Game closed due to disconnect/timeout.")
+    remove_client(client_id)
+    disconnected_players.pop(client_id, None)
+
+
+def format_board_for_display(board):
+    # Returns a string representation of the board's display_grid (cached by the board until the next shot lands)
+    return board.render()
+
+
+def handle_new_connection(conn, addr, username):
+    """Registers a connection that sent its username: reconnection or new client.
+    Returns the client_id, or None if the connection was refused (and closed)."""
+    client_id = username
+    reconnected = False
+    reconnect_msgs = [] # (client_id, str or Board), sent once we're out of the lock
+    reconnected_board = None # spectators get this board once we're out of the lock
+    with all_locks():
+        if client_id in disconnected_players:
+            if DEBUG_LOG: log(f"\n[DEBUG] SERVER.PY: handle_new_connection: -----Reconnection handling for {client_id}-----")
+            game_state = active_games.get(client_id)
+            if game_state and game_state.get("disconnected"):
+                deadline = game_state.get("reconnect_deadline", 0)
+                if time.monotonic() < deadline:
+                    log(f"[INFO] {client_id} is reconnecting within allowed window.")
+
+                    # --- CLEAN UP OLD HANDLES ---
+                    old_client_data = clients.get(client_id)
+                    if old_client_data:
+                        try:
+                            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: handle_new_connection: Cleaning up old socket for {client_id}.")
+                            _stop_client_writer(old_client_data) # Anything still queued was for the dead socket
+                            if old_client_data.get("socket"):
+                                _close_socket(old_client_data["socket"])
+                        except Exception:
+                            pass
+
+                    # Update reconnection state
+                    game_state["disconnected"] = False
+                    disconnected_players.pop(client_id, None)
+
+                    # Update client data with new socket
+                    clients[client_id]["socket"] = conn
+                    _start_client_writer(client_id, clients[client_id], conn)
+                    _add_broadcast_target(client_id, clients[client_id])
+
+                    # Queue up the notifications, they're sent (and the boards formatted) once we're out of the lock.
+                    # Board objects get formatted then, plain strings go as they are
+                    opponent_id = game_state.get("opponent")
+                    # maybe notify opponent
+                    if opponent_id and opponent_id in active_games:
+                        reconnect_msgs.append((opponent_id, f"[INFO] Player '{client_id}' has reconnected!"))
+
+                    # Notify  reconnected player
+                    reconnect_msgs.append((client_id, "[SYSTEM] You have reconnected to your game!"))
+
+                    # Send  board state
+                    board = game_state.get("board")
+                    if board:
+                        reconnect_msgs.append((client_id, "Here is your current board state:"))
+                        reconnect_msgs.append((client_id, board))
+                    # ------------- ONLY SEND THE APPROPRIATE MESSAGE BASED ON TURN!!!!!!! ---------
+                    if game_state.get("is_current_turn"):
+                        if board:
+                            reconnect_msgs.append((client_id, "Here is your current board state:"))
+                            reconnect_msgs.append((client_id, board))
+                        reconnect_msgs.append((client_id, "\n--- It's your turn! ---"))
+                        reconnect_msgs.append((client_id, "[SYSTEM] Your view of the opponent's board:"))
+                        if opponent_id and opponent_id in active_games:
+                            reconnect_msgs.append((client_id, active_games[opponent_id]["board"]))
+                        reconnect_msgs.append((client_id, "[SYSTEM] Please enter your move (e.g., A1):"))
+                    else:
+                        if board:
+                            reconnect_msgs.append((client_id, "Here is your current board state:"))
+                            reconnect_msgs.append((client_id, board))
+                        reconnect_msgs.append((client_id, "[SYSTEM] Please wait for your turn or continue playing."))
+
+                    # Input on the new socket is already going through the reactor, _handle_username
+                    # ties it to client_id when we return
+
+                    # Broadcast the updated board state to spectators (below, broadcast_game_board_state takes clients_lock)
+                    reconnected_board = board
+                    reconnected = True
+                else:
+                    log(f"[INFO] {client_id} tried to reconnect but missed the deadline.")
+                    try:
+                        send_message_to_client(client_id, "Reconnect window expired. You have forfeited your game.")
+                    except Exception:
+                        pass
+                    _close_socket(conn)
+                    return None
+
+    if reconnected:
+        # Still one packet per message, but everything for the same client goes out as one write
+        batches = {}
+        for target_id, msg in reconnect_msgs:
             try:
-                if opponent_data:
-                    send_message_to_client(opponent_id, f"[SYSTEM] Opponent has {remaining} seconds to reconnect or you will win by forfeit.")
+                batches.setdefault(target_id, []).append(msg if isinstance(msg, str) else format_board_for_display(msg))
             except Exception as e:
-                print(f"[DEBUG] Countdown send_message_to_client failed for opponent {opponent_id}: {e}")
-            time.sleep(1)
-            remaining -= 1
-        print(f"[INFO] Player {client_id} did not reconnect in time. Removing from game.")
-        broadcast_to_all("[SYSTEM] Game closed due to disconnect/timeout.")
-        remove_client(client_id)
-        disconnected_players.pop(client_id, None)
+                log(f"[ERROR] SERVER.PY: handle_new_connection: Failed to format reconnect message for {target_id}: {e}")
+        for target_id, msgs in batches.items():
+            send_messages_to_client(target_id, msgs)
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: handle_new_connection: Sent reconnect state to {client_id}.")
+        if reconnected_board:
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: handle_new_connection: Broadcasting board state to spectators after {client_id} reconnected.")
+            broadcast_game_board_state(reconnected_board, reconnected_board)
+            # Both players' boards are the same for reconnection
+        return client_id
+
+    # One critical section for the checks and the insert, so two connects can't both pass the checks.
+    # Refusals get sent once we're out of it
+    refusal = None
+    with all_locks():
+        # Connection Limit Check
+        if len(clients) >= MAX_CONNECTIONS:
+            log(f"[INFO] Connection from {addr} refused. Max connections ({MAX_CONNECTIONS}) reached.")
+            refusal = _MAX_CONNECTIONS_REFUSAL_BYTES
+        # Username uniqueness check
+        elif username in clients:
+            log(f"[INFO] SERVER.PY: handle_new_connection: Username '{username}' already in use. Refusing connection from {addr}.")
+            refusal = _USERNAME_TAKEN_PACKET # Uses packets
+        else:
+            log(f"[INFO] Connection established with {addr}, assigned ID {client_id}")
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: handle_new_connection: Accepted connection. Setting up client data.")
+            # Determine role (player or spectator)
+            role = "spectator" # Default to spectator because always 1 player connects first
+            if len(players_waiting) < 2 and not game_in_progress:
+                role = "player"
+                players_waiting.append(client_id)
+                position = len(players_waiting) # Just appended, no need to search for it
+                if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: handle_new_connection: {client_id} added to players_waiting.")
+                # Input queue for players is created when they are promoted to a game
+
+            else:
+                _enqueue_spectator(client_id)
+                # Position in the combined queue (players first) for initial message
+                position = len(players_waiting) + spectator_rank[client_id] + 1
+                if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: handle_new_connection: {client_id} added to spectators_waiting.")
+            welcome_game_in_progress = game_in_progress
+
+            clients[client_id] = {
+                "socket": conn,
+                "addr": addr,
+                "id": client_id,
+                "role": role,
+                "input_queue": None,
+                "last_input_ns": time.monotonic_ns()
+            }
+            _start_client_writer(client_id, clients[client_id], conn)
+            _add_broadcast_target(client_id, clients[client_id])
+            if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: handle_new_connection: Client data stored for {client_id} with role {role}. Total clients: {len(clients)}")
+
+    if refusal is not None:
+        try:
+            _send_nowait(conn, refusal)
+        except Exception as e:
+            log(f"[ERROR] SERVER.PY: handle_new_connection: Error sending refusal message to {addr}: {e}")
+        finally:
+            _close_socket(conn)
+        return None
 
-    # Start the countdown in a thread AFTER updating state
-    timer_thread = threading.Thread(target=countdown_and_remove, daemon=True)
-    timer_thread.start()
+    # Send initial welcome message, only the variable bits get formatted.
+    # position was taken when they were queued above, so no second lock or list search here
+    welcome_parts = [f"[SYSTEM] Welcome! Your ID is {client_id}.\n".encode()]
+    if role == "player":
+        if position < len(_PLAYER_QUEUE_LINES):
+            welcome_parts.append(_PLAYER_QUEUE_LINES[position])
+        else:
+            welcome_parts.append(f"[SYSTEM] You are #{position} in the player queue.\n".encode())
+        welcome_parts.append(_WAITING_FOR_OPPONENT_BYTES)
+    else: # Spectator
+        if position < len(_SPECTATOR_QUEUE_LINES):
+            welcome_parts.append(_SPECTATOR_QUEUE_LINES[position])
+        else:
+            welcome_parts.append(f"[SYSTEM] You are Spectator #{position} in the queue.\n".encode())
+        if welcome_game_in_progress:
+            welcome_parts.append(_GAME_IN_PROGRESS_BYTES)
+        else:
+            welcome_parts.append(_WAITING_FOR_GAME_BYTES)
 
-    # store the timer thread jus in case
-    disconnected_players[client_id]["timer"] = timer_thread
+    # Welcome + help hint go out as two packets in one syscall
+    welcome_packet = pack_packet(0, SYSTEM_MESSAGE, b"".join(welcome_parts))
+    send_packets_to_client(client_id, [welcome_packet, _HELP_PACKET])
 
 
-def format_board_for_display(board):
-    # Returns a string representation of the board's display_grid
-    lines = []
-    header = "  " + "".join(str(i + 1).rjust(2) for i in range(board.size))
-    lines.append(header)
-    for r_idx in range(board.size):
-        row_label = chr(ord('A') + r_idx)
-        row_str = " ".join(board.display_grid[r_idx][c_idx] for c_idx in range(board.size))
-        lines.append(f"{row_label:2} {row_str}")
-    return "\n".join(lines)
+    # Check if a new game can start after a new client connects
+    matchmaking_dirty.set()
+    return client_id
+
 
 def main():
     """Main function to start the server."""
-    print(f"[INFO] Server listening on {HOST}:{PORT}")
-    print(f"[DEBUG] SERVER.PY: main: main function started.")
+    start_log_writer()
+    log(f"[INFO] Server listening on {HOST}:{PORT}")
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: main: main function started.")
     server_socket = None
+    sel = None
+
+    # Every client/game/timer thread gets this instead of the OS default stack
+    threading.stack_size(THREAD_STACK_SIZE)
 
     try:
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        print(f"[DEBUG] SERVER.PY: main: Socket created.")
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: main: Socket created.")
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        print(f"[DEBUG] SERVER.PY: main: Socket option SO_REUSEADDR set.")
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: main: Socket option SO_REUSEADDR set.")
+        # Set before listen() so accepted sockets start with these too (the receive window gets
+        # negotiated in the handshake). A full spectator board burst then fits in the kernel buffer
+        # and the writer threads rarely block on it. Kernel may clamp it to net.core.*mem_max, that's fine
+        for opt in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                server_socket.setsockopt(socket.SOL_SOCKET, opt, SOCKET_BUFFER_SIZE)
+            except OSError as e:
+                log(f"[WARN] Could not set socket buffer size ({opt}): {e}")
         server_socket.bind((HOST, PORT))
-        print(f"[INFO] Socket bound to {HOST}:{PORT}")
+        log(f"[INFO] Socket bound to {HOST}:{PORT}")
         server_socket.listen()
-        print(f"[INFO] Server listening for incoming connections...")
+        log(f"[INFO] Server listening for incoming connections...")
+
+        threading.Thread(target=spectator_position_worker, daemon=True).start()
+        threading.Thread(target=reconnect_timer_worker, daemon=True).start()
+        threading.Thread(target=matchmaker_worker, daemon=True).start()
+        for _ in range(INPUT_WORKERS):
+            input_q = queue.SimpleQueue()
+            _input_qs.append(input_q)
+            threading.Thread(target=input_worker, args=(input_q,), daemon=True).start()
+
+        # One reactor for everything: the listener plus every client socket (data = read state from _accept_client)
+        sel = selectors.DefaultSelector() # epoll/kqueue where available
+        server_socket.setblocking(False)
+        sel.register(server_socket, selectors.EVENT_READ, data="listener")
+
+        # Everything allocated so far (modules, constants, packet tables) lives for the whole run,
+        # move it out of the collector's generations so gen2 sweeps don't keep rescanning it
+        gc.collect()
+        gc.freeze()
 
+        accept_paused_until = None # monotonic time to put the listener back in the selector, see ACCEPT_BACKOFF
+        accept_failing = False # already logged this run of out-of-fds errors, stays quiet until an accept works
+        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: main: Waiting for a new connection...")
         while True:
-            print(f"[DEBUG] SERVER.PY: main: Waiting for a new connection...")
             try:
-                conn, addr = server_socket.accept()
-
-                username = get_client_username(conn, addr)
-                if not username:
-                    conn.close()
-                    continue  # Skip to next accept loop iteration
-                client_id = username
-                with lock:
-                    if client_id in disconnected_players:
-                        print(f"\n[DEBUG] SERVER.PY: main: -----Reconnection handling for {client_id}-----")
-                        game_state = active_games.get(client_id)
-                        if game_state and game_state.get("disconnected"):
-                            deadline = game_state.get("reconnect_deadline", 0)
-                            if time.time() < deadline:
-                                print(f"[INFO] {client_id} is reconnecting within allowed window.")
-
-                                # --- CLEAN UP OLD HANDLES ---
-                                old_client_data = clients.get(client_id)
-                                if old_client_data:
-                                    try:
-                                        print(f"[DEBUG] SERVER.PY: main: Cleaning up old socket for {client_id}.")
-                                        if old_client_data.get("socket"):
-                                            old_client_data["socket"].close()
-                                    except Exception:
-                                        pass
-
-                                # Update reconnection state
-                                game_state["disconnected"] = False
-                                disconnected_players.pop(client_id, None)
-
-                                # Update client data with new socket
-                                clients[client_id]["socket"] = conn
-
-                                # maybe notify opponent
-                                opponent_id = game_state.get("opponent")
-                                if opponent_id and opponent_id in active_games:
-                                    try:
-                                        send_message_to_client(opponent_id, f"[INFO] Player '{client_id}' has reconnected!")
-                                        print(f"[DEBUG] SERVER.PY: main: Notifying opponent {opponent_id} of {client_id} reconnection.")
-                                    except Exception:
-                                        pass
-
-                                # Notify  reconnected player
-                                try:
-                                    send_message_to_client(client_id, "[SYSTEM] You have reconnected to your game!")
-                                    print(f"[DEBUG] SERVER.PY: main: Notifying {client_id} of successful reconnection.")
-                                except Exception:
-                                    pass
-
-                                # Send  board state
-                                board = game_state.get("board")
-                                if board:
-                                    send_message_to_client(client_id, "Here is your current board state:")
-                                    send_message_to_client(client_id, format_board_for_display(board))
-                                # ------------- ONLY SEND THE APPROPRIATE MESSAGE BASED ON TURN!!!!!!! ---------
-                                if game_state.get("is_current_turn"):
-                                    try:
-                                        board = game_state.get("board")
-                                        if board:
-                                            send_message_to_client(client_id, "Here is your current board state:")
-                                            send_message_to_client(client_id, format_board_for_display(board))
-                                        send_message_to_client(client_id, "\n--- It's your turn! ---")
-                                        send_message_to_client(client_id, "[SYSTEM] Your view of the opponent's board:")
-                                        opponent_id = game_state.get("opponent")
-                                        if opponent_id and opponent_id in active_games:
-                                            opponent_board = active_games[opponent_id]["board"]
-                                            send_message_to_client(client_id, format_board_for_display(opponent_board))
-                                        send_message_to_client(client_id, "[SYSTEM] Please enter your move (e.g., A1):")
-                                        print(f"[DEBUG] SERVER.PY: main: Re-sent turn prompt to {client_id} after reconnection.")
-                                    except Exception as e:
-                                        print(f"[ERROR] SERVER.PY: main: Failed to re-send turn prompt to {client_id}: {e}")
-                                else:
-                                    board = game_state.get("board")
-                                    if board:
-                                        send_message_to_client(client_id, "Here is your current board state:")
-                                        send_message_to_client(client_id, format_board_for_display(board))
-                                    send_message_to_client(client_id, "[SYSTEM] Please wait for your turn or continue playing.")
-
-                                # -------- THIS IS CRUCIAL!!!!! restart input handler thread!!!!! -----------
-                                threading.Thread(target=handle_client_input, args=(client_id,), daemon=True).start()
-                                print(f"[DEBUG] SERVER.PY: main: Restarting handle_client_input thread for {client_id} after reconnection.")
-
-                                # Broadcast the updated board state to spectators
-                                if game_state.get("board"):
-                                    print(f"[DEBUG] SERVER.PY: main: Broadcasting board state to spectators after {client_id} reconnected.")
-                                    broadcast_game_board_state(game_state["board"], game_state["board"])
-                                    # Both players' boards are the same for reconnection
-
-                                continue  # Skip to next accept loop iteration
-                            else:
-                                print(f"[INFO] {client_id} tried to reconnect but missed the deadline.")
-                                try:
-                                    send_message_to_client(client_id, "Reconnect window expired. You have forfeited your game.")
-                                except Exception:
-                                    pass
-                                conn.close()
-                                continue
-
-
-                with lock:
-                    # Connection Limit Check
-                    if len(clients) >= MAX_CONNECTIONS:
-                        print(f"[INFO] Connection from {addr} refused. Max connections ({MAX_CONNECTIONS}) reached.")
-                        try:
-                            temp_wfile = conn.makefile('w')
-                            temp_wfile.write(f"[SYSTEM] Connection refused: Maximum connections ({MAX_CONNECTIONS}) reached. Please try again later.\n")
-                            temp_wfile.flush()
-                            temp_wfile.close()
-                        except Exception as e:
-                            print(f"[ERROR] SERVER.PY: main: Error sending refusal message to {addr}: {e}")
-                        finally:
-                            conn.close()
-                        continue
-
-                    # Username uniqueness check
-                    if username in clients:
-                        print(f"[INFO] SERVER.PY: main: Username '{username}' already in use. Refusing connection from {addr}.")
-                        try:
-                            # Uses packets
-                            packet = pack_packet(0, SYSTEM_MESSAGE, b"Username already in use. Please reconnect with a different name.")
-                            conn.sendall(packet)
-                        except Exception:
-                            pass
-                        conn.close()
-                        continue
-
-                    client_id = username
-                with lock:
-                    # Connection Limit Check again
-                    if len(clients) >= MAX_CONNECTIONS:
-                        print(f"[INFO] Connection from {addr} refused. Max connections ({MAX_CONNECTIONS}) reached.")
-                        try:
-                            # Attempt to send a message before closing
-                            temp_wfile = conn.makefile('w')
-                            temp_wfile.write(f"[SYSTEM] Connection refused: Maximum connections ({MAX_CONNECTIONS}) reached. Please try again later.\n")
-                            temp_wfile.flush()
-                            temp_wfile.close()
-                        except Exception as e:
-                            print(f"[ERROR] SERVER.PY: main: Error sending refusal message to {addr}: {e}")
-                        finally:
-                            conn.close() # Ensure the socket is closed
-                        continue # Skip to the next accept loop iteration
-
-                print(f"[INFO] Connection established with {addr}, assigned ID {client_id}")
-                print(f"[DEBUG] SERVER.PY: main: Accepted connection. Setting up client data.")
-
-                with lock:
-                    # Determine role (player or spectator)
-                    role = "spectator" # Default to spectator because always 1 player connects first
-                    if len(players_waiting) < 2 and not game_in_progress:
-                        role = "player"
-                        players_waiting.append(client_id)
-                        print(f"[DEBUG] SERVER.PY: main: {client_id} added to players_waiting.")
-                        # Input queue for players is created when they are promoted to a game
-
+                timeout = SELECT_TIMEOUT
+                if accept_paused_until is not None:
+                    remaining = accept_paused_until - time.monotonic()
+                    if remaining <= 0:
+                        sel.register(server_socket, selectors.EVENT_READ, data="listener")
+                        accept_paused_until = None
                     else:
-                        spectators_waiting.append(client_id)
-                        print(f"[DEBUG] SERVER.PY: main: {client_id} added to spectators_waiting.")
-
-                    clients[client_id] = {
-                        "socket": conn,
-                        "addr": addr,
-                        "id": client_id,
-                        "role": role,
-                        "input_queue": None,
-                        "last_input_time": time.time()
-                    }
-                    print(f"[DEBUG] SERVER.PY: main: Client data stored for {client_id} with role {role}. Total clients: {len(clients)}")
-
-
-                # Start a dedicated thread to handle input from this client
-                threading.Thread(target=handle_client_input, args=(client_id,), daemon=True).start()
-                print(f"[DEBUG] SERVER.PY: main: handle_client_input thread started for {client_id}")
-
-                # Send initial welcome message
-                welcome_message = f"[SYSTEM] Welcome! Your ID is {client_id}.\n"
-                with lock: # Access waiting lists under lock for accurate position
-                    if role == "player":
-                         position_in_queue = players_waiting.index(client_id) + 1 if client_id in players_waiting else -1 # Should be in list
-                         if position_in_queue != -1:
-                             welcome_message += f"[SYSTEM] You are #{position_in_queue} in the player queue.\n"
-                         welcome_message += f"[SYSTEM] Waiting for another player to join...\n"
-                    else: # Spectator
-                         # Find position in the combined queue for initial message
-                         combined_queue = players_waiting + spectators_waiting
-                         position = -1
-                         try:
-                             position = combined_queue.index(client_id) + 1
-                         except ValueError: # Should not happen
-                              pass # Keep position as -1
-
-                         if position != -1:
-                            welcome_message += f"[SYSTEM] You are Spectator #{position} in the queue.\n"
-                            if game_in_progress:
-                                welcome_message += "[SYSTEM] A game is currently in progress. You will receive updates.\n"
-                            else:
-                                welcome_message += "[SYSTEM] Waiting for players to start a new game.\n"
-
-                send_message_to_client(client_id, welcome_message)
-                send_message_to_client(client_id, "[SYSTEM] Type /help for available commands.")
-
-
-                # Check if a new game can start after a new client connects
-                check_start_game()
-
+                        timeout = remaining if timeout is None else min(timeout, remaining)
+                # No idle wakeups: sleeps until a client or the listener is readable (see SELECT_TIMEOUT)
+                for key, _ in sel.select(timeout=timeout):
+                    if key.data == "listener":
+                        # Drain the whole backlog per wakeup instead of one accept per select()
+                        while True:
+                            try:
+                                conn, addr = server_socket.accept()
+                            except BlockingIOError:
+                                break # Backlog empty
+                            except InterruptedError:
+                                continue # EINTR, just retry
+                            except OSError as e:
+                                if e.errno in ACCEPT_RETRY_ERRNOS:
+                                    continue # Peer gave up before we got to it, try the next one
+                                if e.errno in ACCEPT_BACKOFF_ERRNOS:
+                                    # Out of fds, leave the rest in the backlog until something closes.
+                                    # The listener stays readable (level-triggered), so take it out of the
+                                    # selector for a bit or we'd spin on select() + this log line
+                                    if not accept_failing:
+                                        log(f"[ERROR] SERVER.PY: main: Can't accept more connections right now: {e}. Retrying every {ACCEPT_BACKOFF}s.")
+                                        accept_failing = True
+                                    sel.unregister(server_socket)
+                                    accept_paused_until = time.monotonic() + ACCEPT_BACKOFF
+                                    break
+                                raise
+                            if accept_failing:
+                                log(f"[INFO] Accepting connections again.")
+                                accept_failing = False
+                            _accept_client(sel, conn, addr)
+                        if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: main: Waiting for a new connection...")
+                    else:
+                        _read_client(sel, key.data)
 
             except KeyboardInterrupt:
-                print(f"[INFO] Server shutting down due to KeyboardInterrupt.")
+                log(f"[INFO] Server shutting down due to KeyboardInterrupt.")
                 break # Exit the loop on Ctrl+C
             except Exception as e:
-                print(f"[ERROR] SERVER.PY: main: Error accepting connection: {e}")
+                # Expected accept() errors are handled above, this is for genuinely unexpected failures
+                log(f"[ERROR] SERVER.PY: main: Unexpected error handling connection: {type(e).__name__}: {e}")
                 # Continue listening even if one connection fails
 
     except Exception as e:
-        print(f"[CRITICAL ERROR] Server failed to start or run: {e}")
+        log(f"[CRITICAL ERROR] Server failed to start or run: {e}")
     finally:
-        print(f"[INFO] Server main loop ended. Shutting down.")
+        log(f"[INFO] Server main loop ended. Shutting down.")
+        if sel:
+            sel.close()
         if server_socket:
             server_socket.close()
-            print("[INFO] Server socket closed.")
-
-        # Attempt to clean up all client connections
-        client_ids_to_close = []
-        with lock:
-             client_ids_to_close = list(clients.keys())
-        for client_id in client_ids_to_close:
-            print(f"[INFO] Cleaning up resources for client {client_id} during shutdown.")
-            remove_client(client_id) # This handles closing files and socket
-
-        print(f"[INFO] Server has shut down.")
+            log("[INFO] Server socket closed.")
+
+        # Attempt to clean up all client connections.
+        # Not going through remove_client here: that would take all the locks per client,
+        # start reconnect timers and try to kick off new games while we're exiting.
+        # Just snapshot everyone once and close the sockets in parallel.
+        with clients_lock:
+            clients_to_close = tuple(clients.values())
+        if clients_to_close:
+            for client_data in clients_to_close:
+                log(f"[INFO] Cleaning up resources for client {client_data.get('id')} during shutdown.")
+                # Just a put on the outbox, the close below gives the writer CLOSE_FLUSH_TIMEOUT to send it
+                _enqueue_packet(client_data.get('id'), client_data, _SHUTDOWN_PACKET)
+            with ThreadPoolExecutor(max_workers=min(SHUTDOWN_CLOSE_WORKERS, len(clients_to_close))) as ex:
+                list(ex.map(_close_client_connection, clients_to_close))
+
+        log(f"[INFO] Server has shut down.")
+        stop_log_writer() # Daemon writer dies with the process, make sure the tail gets out
 
 if __name__ == "__main__":
-    print(f"[DEBUG] SERVER.PY: <module>: Script started. Calling main().")
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: <module>: Script started. Calling main().")
     main()
-    print(f"[DEBUG] SERVER.PY: <module>: main() finished.")
\ No newline at end of file
+    if DEBUG_LOG: log(f"[DEBUG] SERVER.PY: <module>: main() finished.")
\ No newline at end of file